@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from itertools import groupby as group_by
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from generate_tree import TreeGenerator, exit_if_not_empty, parser_logic as tree_parser_logic  # noqa: E402
+from groupby import print_groups  # noqa: E402
+from util.ActionCreateFilter import ActionAppendFilePropertyFilter, DuplicateFilters  # noqa: E402
+from util.ActionCreateFunc import print_results  # noqa: E402
+from util.DirectorySearch import FileRecord, directory_search, file_stat  # noqa: E402
+from util.Output import GroupWriter, formats as output_formats  # noqa: E402
+from util.Templates import BraceExpansion, EscapedBraceExpansion, negation  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+_version = 1
+# Templates rendered for each file
+brace_templates = ('{}', '{//}/{/.}_{f1}{..}', 'mv {} {f1}/{/}')
+
+
+class GroupsFound(list):
+    '''
+        Groups already filtered, given to print_groups as DuplicateFilters gives them
+    '''
+
+    def __init__(self, groups):
+        super().__init__(results for results, filter_hashes in groups)
+        self.filter_hashes = dict()
+        self._groups = groups
+
+    def __iter__(self):
+        # filter_hashes is emptied as groups are labeled, so is filled again each time
+        self.filter_hashes = {results[0]: list(filter_hashes) for results, filter_hashes in self._groups}
+        return super().__iter__()
+
+
+class Benchmark:
+    '''
+        Times each part of groupby on the same tree, each part repeat times.
+        Results are kept as the seconds of each run, with the number of items handled
+    '''
+
+    def __init__(self, root, *, repeat=3):
+        self.root = root
+        self.repeat = repeat
+        self.results = OrderedDict()
+
+    def time(self, name, func, *, items=None):
+        seconds = list()
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - start)
+        result = {'seconds': [round(second, 6) for second in seconds],
+                  'min': round(min(seconds), 6),
+                  'median': round(statistics.median(seconds), 6)}
+        if items is not None:
+            result['items'] = items
+            result['per_second'] = round(items / min(seconds), 1) if min(seconds) > 0 else None
+        self.results[name] = result
+        print("{name:<40} {seconds:>10.4f}s".format(name=name, seconds=min(seconds)), file=sys.stderr)
+        return result
+
+    def search(self, **kwargs) -> list:
+        return list(directory_search(self.root, recursive=True, **kwargs))
+
+    def run(self):
+        filenames = self.search()
+        count = len(filenames)
+        self.time('directory_search', self.search, items=count)
+        self.time('directory_search/dir_hidden', lambda: self.search(dir_hidden=True),
+                  items=len(self.search(dir_hidden=True)))
+
+        # A new FileRecord each run, so the stat of the file isn't kept from the run before
+        def records():
+            return [FileRecord(filename) for filename in filenames]
+
+        for name in ActionAppendFilePropertyFilter.filters():
+            if name in ActionAppendFilePropertyFilter.group_filters:
+                continue
+            filter_func = ActionAppendFilePropertyFilter._process(name)
+            self.time('filter/{}'.format(name), lambda: [filter_func(filename) for filename in records()],
+                      items=count)
+
+        # Group filters are given each group of files of the same size
+        def size(filename):
+            return file_stat(filename).st_size
+        size_groups = [list(group) for file_size, group in group_by(sorted(filenames, key=size), key=size)]
+        size_groups = [group for group in size_groups if len(group) > 1]
+        for name in ActionAppendFilePropertyFilter.group_filters:
+            filter_func = ActionAppendFilePropertyFilter._process(name)
+            self.time('filter/{}'.format(name), lambda: [filter_func(group) for group in size_groups],
+                      items=sum(len(group) for group in size_groups))
+
+        conditions = [FileRecord.is_file, negation(FileRecord.is_symlink),
+                      lambda filename: filename.stat().st_size > 0]
+        stages = {
+            'size+md5': ("size", "md5"),
+            'duplicates': ("size", "head", "tail", "sample", "md5"),
+        }
+        found = None
+        for name, stage_names in stages.items():
+            def duplicate_filters():
+                filters = [ActionAppendFilePropertyFilter._process(stage) for stage in stage_names]
+                duplicates = DuplicateFilters(filters=filters, filenames=self.search(), conditions=conditions,
+                                              group_size=2)
+                return [(results, duplicates.filter_hashes[results[0]]) for results in duplicates]
+            self.time('DuplicateFilters/{}'.format(name), duplicate_filters, items=count)
+            if found is None:
+                found = duplicate_filters()
+
+        for template in brace_templates:
+            for expansion in (BraceExpansion, EscapedBraceExpansion):
+                command = expansion(template)
+                self.time('{}/{}'.format(expansion.__name__, template),
+                          lambda: [command(filename, f1='16384') for filename in filenames],
+                          items=count)
+
+        groups = GroupsFound(found)
+        files = sum(len(results) for results, filter_hashes in found)
+        self.time('output/human', lambda: self._output(groups), items=files)
+        for output_format in output_formats:
+            if output_format == 'human':
+                continue
+            self.time('output/{}'.format(output_format),
+                      lambda: self._output(groups, output_format=output_format),
+                      items=files)
+        return self.results
+
+    @staticmethod
+    def _output(groups, output_format='human'):
+        # Written to a file thrown away, through the same path as standard output
+        stdout = sys.stdout
+        with open(os.devnull, 'wb', buffering=0) as devnull:
+            if output_format == 'human':
+                sys.stdout = io.TextIOWrapper(io.BufferedWriter(devnull), errors='surrogateescape')
+                group_action = print_results
+            else:
+                group_action = GroupWriter(output_format, file=io.BufferedWriter(devnull, buffer_size=1048576))
+            try:
+                print_groups(groups, group_action=group_action, group_size=2)
+                if output_format == 'human':
+                    sys.stdout.flush()
+                else:
+                    group_action.close()
+            finally:
+                sys.stdout = stdout
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    # Prints the change in the fastest run of each part, from the results of another commit
+    if previous['tree'] != current['tree']:
+        print("The trees timed are not the same, generated with other parameters", file=sys.stderr)
+    print("{:<40} {:>10} {:>10} {:>8}".format('', 'before', 'after', 'change'))
+    for name, result in current['results'].items():
+        before = previous['results'].get(name)
+        if before is None:
+            continue
+        change = result['min'] / before['min'] if before['min'] > 0 else float('inf')
+        print("{name:<40} {before:>9.4f}s {after:>9.4f}s {change:>7.2f}x".format(
+            name=name, before=before['min'], after=result['min'], change=change))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="time each part of groupby on a generated tree")
+    # The tree is written in a temporary directory unless given
+    parser = tree_parser_logic(parser, directory_required=False)
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each part, the fastest is compared\n"
+                                                               "default = 3")
+    parser.add_argument('--output', metavar='FILE', help="write the results as JSON to FILE")
+    parser.add_argument('--compare', metavar='FILE', help="compare with the results of an earlier run")
+    parser.add_argument('--keep', action='store_true', help="keep the tree written in a temporary directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr, format='[%(levelname)s] %(message)s')
+
+    generator = TreeGenerator(files=args.files, depth=args.depth, width=args.width, size=args.size,
+                              distribution=args.distribution, duplicates=args.duplicates,
+                              hardlinks=args.hardlinks, hidden=args.hidden, sparse=args.sparse, seed=args.seed)
+    if args.directory is not None:
+        exit_if_not_empty(args.directory)
+        root = args.directory
+    else:
+        root = tempfile.mkdtemp(prefix='groupby-bench-')
+    try:
+        start = time.perf_counter()
+        tree = generator.generate(root)
+        print("{name:<40} {seconds:>10.4f}s".format(name='generate', seconds=time.perf_counter() - start),
+              file=sys.stderr)
+        results = Benchmark(root, repeat=args.repeat).run()
+    finally:
+        if args.directory is None and args.keep is False:
+            shutil.rmtree(root, ignore_errors=True)
+        elif args.directory is None:
+            print("Tree kept in {}".format(root), file=sys.stderr)
+
+    report = {'benchmark': _version,
+              'commit': _commit(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'tree': tree,
+              'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+            file.write('\n')
+    if args.compare is not None:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == '__main__':
+    main()
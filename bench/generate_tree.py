@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+# Contents of every file are taken from this many seeded random bytes
+_pool_size = 4194304
+_header = '{seed:08x}{number:016x}'
+size_distributions = ('lognormal', 'uniform', 'fixed')
+
+
+class TreeGenerator:
+    '''
+        Writes a directory tree of files to search and group, the same for the same seed.
+        A share of files are copies of an earlier file, hard links to one, sparse,
+        or in hidden directories. Each distinct file starts with its own number,
+        so files are only duplicates when made as one
+    '''
+
+    def __init__(self, *, files=10000, depth=3, width=8, size=16384, distribution='lognormal',
+                 duplicates=0.2, hardlinks=0.02, hidden=0.1, sparse=0.01, seed=0):
+        self.files = files
+        self.depth = depth
+        self.width = width
+        self.size = size
+        self.distribution = distribution
+        self.duplicates = duplicates
+        self.hardlinks = hardlinks
+        self.hidden = hidden
+        self.sparse = sparse
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._pool = None
+
+    def parameters(self) -> dict:
+        return {'files': self.files, 'depth': self.depth, 'width': self.width, 'size': self.size,
+                'distribution': self.distribution, 'duplicates': self.duplicates, 'hardlinks': self.hardlinks,
+                'hidden': self.hidden, 'sparse': self.sparse, 'seed': self.seed}
+
+    def _file_size(self) -> int:
+        if self.distribution == 'fixed':
+            return self.size
+        if self.distribution == 'uniform':
+            return self._random.randint(0, self.size * 2)
+        # Most files small, a few large, with a median of size
+        return int(self._random.lognormvariate(math.log(max(self.size, 1)), 1.5))
+
+    def _directories(self, root) -> list:
+        # Every directory of a tree width wide and depth deep, a share of them hidden
+        directories = [root]
+        level = [root]
+        for _ in range(self.depth):
+            next_level = list()
+            for parent in level:
+                for number in range(self.width):
+                    name = 'dir{:03d}'.format(number)
+                    if self._random.random() < self.hidden:
+                        name = '.' + name
+                    next_level.append(os.path.join(parent, name))
+            directories.extend(next_level)
+            level = next_level
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+        return directories
+
+    def _contents(self, number, size) -> bytes:
+        header = _header.format(seed=self.seed, number=number).encode()
+        if size <= len(header):
+            return header[:size]
+        body_size = size - len(header)
+        start = self._random.randrange(_pool_size)
+        body = bytearray()
+        while len(body) < body_size:
+            body += self._pool[start:start + body_size - len(body)]
+            start = 0
+        return header + bytes(body)
+
+    def generate(self, root) -> dict:
+        # Returns what was written, along with the parameters
+        self._random.seed(self.seed)
+        if self._pool is None:
+            self._pool = random.Random(self.seed).getrandbits(_pool_size * 8).to_bytes(_pool_size, 'little')
+        directories = self._directories(root)
+        # (path, size, number) of each distinct file written
+        written = list()
+        counts = {'files': 0, 'distinct': 0, 'duplicates': 0, 'hardlinks': 0, 'sparse': 0, 'bytes': 0}
+        for number in range(self.files):
+            path = os.path.join(self._random.choice(directories), 'file{:07d}.dat'.format(number))
+            kind = self._random.random()
+            if written and kind < self.hardlinks:
+                os.link(self._random.choice(written)[0], path)
+                counts['hardlinks'] += 1
+            elif written and kind < self.hardlinks + self.duplicates:
+                source, size, source_number = self._random.choice(written)
+                with open(source, 'rb') as source_file, open(path, 'wb') as file:
+                    file.write(source_file.read())
+                counts['duplicates'] += 1
+                counts['bytes'] += size
+            elif kind < self.hardlinks + self.duplicates + self.sparse:
+                # Only the start is written, the rest is a hole
+                size = max(self._file_size(), 1048576)
+                with open(path, 'wb') as file:
+                    file.write(self._contents(number, 4096))
+                    file.truncate(size)
+                written.append((path, size, number))
+                counts['sparse'] += 1
+                counts['bytes'] += size
+            else:
+                size = self._file_size()
+                with open(path, 'wb') as file:
+                    file.write(self._contents(number, size))
+                written.append((path, size, number))
+                counts['distinct'] += 1
+                counts['bytes'] += size
+            counts['files'] += 1
+        counts['directories'] = len(directories)
+        return dict(self.parameters(), **counts)
+
+
+def exit_if_not_empty(directory):
+    if os.path.exists(directory) and os.listdir(directory):
+        print("{} is not empty".format(directory), file=sys.stderr)
+        exit(1)
+
+
+def parser_logic(parser, *, directory_required=True):
+    parser.add_argument('directory',
+                        nargs=None if directory_required is True else '?',
+                        help="empty directory the tree is written in, created if needed",
+                        )
+    parser.add_argument('--files', type=int, default=10000, help="number of files\ndefault = 10000")
+    parser.add_argument('--depth', type=int, default=3, help="levels of directories\ndefault = 3")
+    parser.add_argument('--width', type=int, default=8, help="directories in each directory\ndefault = 8")
+    parser.add_argument('--size', type=int, default=16384,
+                        metavar='BYTES',
+                        help="size of the files, the median for lognormal\ndefault = 16384",
+                        )
+    parser.add_argument('--distribution',
+                        choices=size_distributions,
+                        default='lognormal',
+                        help="how file sizes are spread\n"
+                             "lognormal = mostly small files and a few large\n"
+                             "uniform   = 0 to twice --size\n"
+                             "fixed     = every file --size\n"
+                             "default = lognormal",
+                        )
+    parser.add_argument('--duplicates', type=float, default=0.2, metavar='RATIO',
+                        help="share of files that are a copy of another\ndefault = 0.2")
+    parser.add_argument('--hardlinks', type=float, default=0.02, metavar='RATIO',
+                        help="share of files that are a hard link to another\ndefault = 0.02")
+    parser.add_argument('--hidden', type=float, default=0.1, metavar='RATIO',
+                        help="share of directories that are hidden\ndefault = 0.1")
+    parser.add_argument('--sparse', type=float, default=0.01, metavar='RATIO',
+                        help="share of files that are sparse, of at least 1 MiB\ndefault = 0.01")
+    parser.add_argument('--seed', type=int, default=0, help="the same seed writes the same tree\ndefault = 0")
+    return parser
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    args = parser_logic(parser).parse_args()
+    exit_if_not_empty(args.directory)
+    generator = TreeGenerator(files=args.files, depth=args.depth, width=args.width, size=args.size,
+                              distribution=args.distribution, duplicates=args.duplicates,
+                              hardlinks=args.hardlinks, hidden=args.hidden, sparse=args.sparse, seed=args.seed)
+    print(json.dumps(generator.generate(args.directory), indent=2))
+
+
+if __name__ == '__main__':
+    main()
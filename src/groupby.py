@@ -5,14 +5,33 @@ import logging
 import os
 import sys
 from collections import OrderedDict
+from collections import deque
+from functools import partial
+from itertools import chain
 
-from util.ActionCreateFilter import DuplicateFilters, ActionAppendFilePropertyFilter
-from util.ActionCreateFunc import print_results
+from util.ActionCreateFilter import DuplicateFilters, CompactDuplicateFilters, StreamingFilters, \
+    WatchedFilters, ActionAppendFilePropertyFilter
+from util.ActionCreateFunc import ActionAppendMerge, print_results, remove_files, hardlink_files
 from util.ArgumentParsing import parser_logic
-from util.DirectorySearch import directory_search
+from util.BatchOperations import Journal, batch, describe, number_operations, read_plan, write_plan
+from util.BatchOperations import run as run_operations
+from util.CopyEngine import CopyEngine
+from util.DeviceScheduler import DeviceScheduler
+from util.DirectorySearch import FileRecord, ParallelWalker, directory_search, distinct_roots, file_searched, \
+    filenames_from, search_descend
+from util.FilterCache import filter_cache
 from util.Logging import log_levels
+from util.Output import GroupWriter
+from util.Parallel import ordered_map
+from util.ShellPool import ShellPool
+from util.Snapshot import snapshot
+from util.Templates import ShellCommandError
 from util.Templates import negation
 from util.Templates import sanitize_object
+from util.Templates import set_shell_pool
+from util.Watch import Watcher
+
+log = logging.getLogger(__name__)
 
 
 def main():
@@ -31,29 +50,162 @@ def main():
                             format='[%(levelname)s] %(message)s',
                             )
 
-    # Usage of set to remove directories specified multiple times
-    paths = (path for directory in set(args.directories)
-             for path in directory_search(directory,
-                                          recursive=args.recursive,
-                                          dir_hidden=args.dir_hidden,
-                                          max_depth=args.max_depth,
-                                          include=args.include,
-                                          exclude=args.exclude,
-                                          dir_include=args.dir_include,
-                                          dir_exclude=args.dir_exclude,
-                                          )
-             )
+    # Files planned to be removed or linked by an earlier run, nothing is searched
+    if args.resume is not None or args.rollback is not None:
+        journal = Journal.load(args.resume if args.resume is not None else args.rollback)
+        if journal.state is not None:
+            log.error("{path} is already {state}".format(path=sanitize_object(journal.path),
+                                                        state=journal.state.replace('_', ' ')))
+            exit(1)
+        if args.rollback is not None:
+            if args.dry_run is True:
+                log.error("--dry-run can not be used with --rollback")
+                exit(1)
+            exit(0 if journal.rollback() is True else 1)
+        if args.dry_run is True:
+            print_plan([[operation for operation in group if operation['id'] not in journal.done]
+                        for group in journal.groups])
+            exit(0)
+        exit(0 if run_operations(journal.groups, jobs=args.jobs, journal=journal) is True else 1)
+    if args.apply_plan is not None:
+        groups = read_plan(args.apply_plan)
+        if args.dry_run is True:
+            print_plan(groups)
+            exit(0)
+        journal = Journal.create(args.journal, groups) if args.journal is not None else None
+        exit(0 if run_operations(groups, jobs=args.jobs, journal=journal) is True else 1)
+
+    # A snapshot keeps filter output along with directory listings, in place of the cache
+    if args.snapshot is not None:
+        snapshot.open(args.snapshot,
+                      max_age=args.cache_max_age * 24 * 60 * 60,
+                      max_size=args.cache_max_size * 1024 * 1024,
+                      keep_output=args.no_cache is False,
+                      )
+    elif args.cache is not None and args.no_cache is False:
+        filter_cache.open(args.cache,
+                          max_age=args.cache_max_age * 24 * 60 * 60,
+                          max_size=args.cache_max_size * 1024 * 1024,
+                          )
+    scandir = snapshot.scandir if snapshot.enabled else None
+
+    if not args.directories and args.files_from is None:
+        args.directories = [os.getcwd()]
+
+    # Directories specified multiple times, or inside another directory searched, are removed
+    # keeping the order given
+    args.directories, overlapping = distinct_roots(OrderedDict.fromkeys(args.directories),
+                                                   recursive=args.recursive,
+                                                   max_depth=args.max_depth,
+                                                   dir_hidden=args.dir_hidden,
+                                                   )
+    # Paths listed in --files-from may be found again, by another path to the same file
+    if args.files_from is not None:
+        overlapping = True
+
+    # Directories are listed by many threads, each directory searched is listed from the start
+    if args.walk_jobs > 1 or args.walk_order != 'listed':
+        walker = ParallelWalker(jobs=args.walk_jobs, order=args.walk_order, scandir=scandir)
+        # Each listed with the depth and directories its search descends into, as directory_search walks it
+        for directory in args.directories:
+            if os.path.isdir(os.path.expanduser(directory)):
+                walker.prefetch(os.path.expanduser(directory),
+                                max_depth=0 if args.recursive is False else args.max_depth,
+                                descend=search_descend(directory, dir_hidden=args.dir_hidden),
+                                )
+    else:
+        walker = None
+
+    def search():
+        searched = (path for directory in args.directories
+                    for path in directory_search(directory,
+                                                 recursive=args.recursive,
+                                                 dir_hidden=args.dir_hidden,
+                                                 max_depth=args.max_depth,
+                                                 include=args.include,
+                                                 exclude=args.exclude,
+                                                 dir_include=args.dir_include,
+                                                 dir_exclude=args.dir_exclude,
+                                                 scandir=scandir,
+                                                 walker=walker,
+                                                 null=args.null,
+                                                 )
+                    )
+        if args.files_from is None:
+            return searched
+        # Files listed are grouped after those found in the directories
+        return chain(searched, filenames_from(args.files_from, null=args.null))
+    paths = search()
+
+    # Directories are watched before searching them, so no change is missed
+    watcher = None
+    if args.watch is True:
+        if args.compact is True:
+            log.error("--compact can not be used with --watch")
+            exit(1)
+        if args.files_from is not None:
+            log.error("--files-from can not be used with --watch")
+            exit(1)
+        for directory in args.directories:
+            if not os.path.isdir(directory):
+                log.error("{} is not a directory, only directories can be watched".format(
+                    sanitize_object(directory)))
+                exit(1)
+        try:
+            watcher = Watcher(args.directories,
+                              max_depth=0 if args.recursive is False else args.max_depth,
+                              dir_hidden=args.dir_hidden,
+                              )
+        except OSError as e:
+            log.error("Unable to watch directories: {}".format(e.strerror))
+            exit(1)
+        args.stream = True
+
+    # Staged duplicate search, each filter only reads more of files
+    # that are still in a group of two or more
+    if args.duplicates is True:
+        if args.filters:
+            log.error("--duplicates can not be used with --filter")
+            exit(1)
+        args.filters = [ActionAppendFilePropertyFilter._process(stage)
+                        for stage in ("size", "head", "tail", "sample", "md5")]
+        args.group_size = max(args.group_size, 2)
 
     # Default filtering method
     if not args.filters:
-        size = ActionAppendFilePropertyFilter.disk_size
-        md5  = ActionAppendFilePropertyFilter.md5_sum
+        size = ActionAppendFilePropertyFilter._process("size")
+        md5  = ActionAppendFilePropertyFilter._process("md5")
         args.filters = [size, md5]
 
+    ActionAppendFilePropertyFilter.read_size = args.read_size
+    ActionAppendFilePropertyFilter.mmap_threshold = args.mmap_threshold
+    ActionAppendFilePropertyFilter.cache_policy = args.cache_policy
+
+    # One shell for each command that may run at once
+    if args.shell_pool is True:
+        shell_pool = ShellPool(args.jobs)
+        set_shell_pool(shell_pool)
+    else:
+        shell_pool = None
+
+    # Files merged are copied by up to jobs threads
+    merge_engine = ActionAppendMerge.engine = CopyEngine(mode=args.merge_mode, jobs=args.jobs)
+    ActionAppendMerge.dry_run = args.dry_run
+
+    # Content filters read from every device at once, each through its own queue
+    if args.device_jobs is not None:
+        if args.device_jobs < 1:
+            log.error("--device-jobs must be at least 1")
+            exit(1)
+        scheduler = DeviceScheduler(jobs=args.device_jobs)
+    else:
+        scheduler = None
+
+    # Paths are FileRecords, the conditions use the type and stat found while searching
     conditions = {
-        "is_file": os.path.isfile,
-        "not_symbolic_link": negation(os.path.islink),
-        "not_empty": lambda filename: os.path.getsize(filename) > 0,
+        "is_file": FileRecord.is_file,
+        "not_symbolic_link": negation(FileRecord.is_symlink),
+        "not_empty": lambda filename: filename.stat().st_size > 0,
     }
     # Directory condition modifying
     if args.follow_symbolic is True:
@@ -61,41 +213,238 @@ def main():
     if args.empty_file is True:
         conditions.pop("not_empty")
 
-    filtered_groups = DuplicateFilters(filters=args.filters, filenames=paths, conditions=conditions.values())
+    if args.stream is True and args.compact is True:
+        log.error("--compact can not be used with --stream")
+        exit(1)
+
+    if watcher is not None:
+        filtered_groups = WatchedFilters(filters=args.filters,
+                                         filenames=paths,
+                                         conditions=conditions.values(),
+                                         group_size=args.group_size,
+                                         verify=args.verify,
+                                         watcher=watcher,
+                                         search=search,
+                                         searched=partial(file_searched,
+                                                          include=args.include,
+                                                          exclude=args.exclude,
+                                                          dir_include=args.dir_include,
+                                                          dir_exclude=args.dir_exclude,
+                                                          ),
+                                         removed=print_removed,
+                                         )
+    elif args.stream is True:
+        filtered_groups = StreamingFilters(filters=args.filters,
+                                           filenames=paths,
+                                           conditions=conditions.values(),
+                                           group_size=args.group_size,
+                                           verify=args.verify,
+                                           max_singletons=args.stream_max_singletons,
+                                           max_groups=args.stream_max_groups,
+                                           )
+    elif args.compact is True:
+        filtered_groups = CompactDuplicateFilters(filters=args.filters,
+                                                  filenames=paths,
+                                                  conditions=conditions.values(),
+                                                  jobs=args.jobs,
+                                                  group_size=args.group_size,
+                                                  verify=args.verify,
+                                                  batch_size=args.filter_batch,
+                                                  overlapping=overlapping,
+                                                  scheduler=scheduler,
+                                                  )
+    else:
+        filtered_groups = DuplicateFilters(filters=args.filters,
+                                           filenames=paths,
+                                           conditions=conditions.values(),
+                                           jobs=args.jobs,
+                                           group_size=args.group_size,
+                                           verify=args.verify,
+                                           batch_size=args.filter_batch,
+                                           overlapping=overlapping,
+                                           scheduler=scheduler,
+                                           )
 
     # With no action defined, just print the results
     if args.group_action:
         group_action = args.group_action[-1]
     else:
         group_action = print_results
-    for results in filtered_groups:
+    # Results written for other programs, in place of printing them
+    if args.format != 'human':
+        if args.group_action:
+            log.error("--format {} can not be used with an --exec action".format(args.format))
+            exit(1)
+        # A group updated is written again, null has no way to tell it from a new group
+        if args.format == 'null' and args.stream is True:
+            log.error("--format null can not be used with --stream or --watch, use jsonl or csv")
+            exit(1)
+        group_action = GroupWriter(args.format, stream=args.stream)
+    # Removing or linking files is asked once for every group, or written as a plan
+    if args.batch is True or args.write_plan is not None:
+        if group_action not in (remove_files, hardlink_files):
+            log.error("--batch and --write-plan can only be used with --exec-remove or --exec-link")
+            exit(1)
+        if args.stream is True:
+            log.error("--batch and --write-plan can not be used with --stream or --watch")
+            exit(1)
+        batch.enabled = True
+    elif args.journal is not None:
+        log.error("--journal can only be used with --batch or --apply-plan")
+        exit(1)
+    # Nothing is changed, files to remove or link are gathered as with --batch and printed
+    if args.dry_run is True:
+        if group_action in (remove_files, hardlink_files):
+            if args.stream is True:
+                log.error("--dry-run can not be used with --stream or --watch with --exec-remove or --exec-link")
+                exit(1)
+            batch.enabled = True
+        elif not isinstance(group_action, partial) or group_action.func is not ActionAppendMerge._abstract_call:
+            log.error("--dry-run can only be used with --exec-merge, --exec-remove or --exec-link")
+            exit(1)
+
+    shell_error = None
+    try:
+        print_groups(filtered_groups, group_action=group_action, group_size=args.group_size, jobs=args.jobs,
+                     stream=args.stream)
+    except ShellCommandError as e:
+        # The first command to fail, commands already running are finished without being reported
+        shell_error = e
+    finally:
+        if walker is not None:
+            walker.close()
+        if watcher is not None:
+            watcher.close()
+        snapshot.close()
+        filter_cache.close()
+        if shell_pool is not None:
+            shell_pool.close()
+        if scheduler is not None:
+            scheduler.close()
+        if isinstance(group_action, GroupWriter):
+            group_action.close()
+        merged = merge_engine.close()
+    if shell_error is not None:
+        log.error(shell_error)
+        exit(1)
+    if merged is False:
+        exit(1)
+    if batch.enabled is True:
+        run_batch(args)
+
+
+def run_batch(args):
+    groups = number_operations(batch.groups)
+    if args.write_plan is not None:
+        write_plan(args.write_plan, groups)
+        log.info("Plan of {} groups written to {}".format(len(groups), sanitize_object(args.write_plan)))
+        return None
+    if args.dry_run is True:
+        print_plan(groups)
+        return None
+    if not groups:
+        return None
+    print("Are you sure you wish to remove {removed} and hard link {linked} duplicate files, in {count} groups?".format(
+        removed=batch.count('remove'),
+        linked=batch.count('link'),
+        count=len(groups)))
+    if input("Y/N ").upper() != 'Y':
+        print('Exiting...')
+        exit(1)
+    journal = Journal.create(args.journal, groups) if args.journal is not None else None
+    if run_operations(groups, jobs=args.jobs, journal=journal) is False:
+        exit(1)
+
+
+def print_plan(groups):
+    # Each file --dry-run would remove or link, in place of doing it
+    for group in groups:
+        for operation in group:
+            print(describe(operation))
+
+
+def print_groups(filtered_groups, *, group_action, group_size, jobs=1, stream=False):
+    if stream is True:
+        labeled_groups = label_updates(filtered_groups, group_action=group_action)
+    else:
+        labeled_groups = label_groups(filtered_groups, group_size=group_size)
+    # Shell commands of many groups are run at once, output is kept in order of the groups
+    if jobs > 1 and stream is False and getattr(group_action, 'invocations', None) is not None:
+        group_outputs = invoke_groups(labeled_groups, invocations=group_action.invocations, jobs=jobs)
+    else:
+        group_outputs = ((results, group_action(results, labeled_filters=labeled_filters))
+                         for results, labeled_filters in labeled_groups)
+
+    for results, command_string in group_outputs:
         output_string_occurred = False
-        if len(results) >= args.group_size:
-            # Take each filters output and label f1: 1st_output, fn: n_output...
-            # Strip filter_output because of embedded newline
-            labeled_filters = OrderedDict()
-            source_result = results[0]
-            for filter_number, filter_output in enumerate(filtered_groups.filter_hashes[source_result]):
-                labeled_filters["f{fn}".format(fn=filter_number + 1)] = filter_output.strip()
-
-            command_string = group_action(results, labeled_filters=labeled_filters)
-            if command_string is not None:
-                for output in command_string:
-                    if output:
-                        output_string_occurred = True
-
-                        # Sanitize and handle all newline characters from
-                        # messing up output
-                        output = sanitize_object(output)
-                        output = ' '.join(output.splitlines())
-                        print(output)
-                if output_string_occurred is True:
-                    print('')
-            else:
-                continue
+        if command_string is not None:
+            for output in command_string:
+                if output:
+                    output_string_occurred = True
+
+                    # Sanitize and handle all newline characters from
+                    # messing up output
+                    output = sanitize_object(output)
+                    output = ' '.join(output.splitlines())
+                    print(output)
+            if output_string_occurred is True:
+                print('')
+        # Output is shown as each group is found rather than when the buffer fills
+        if stream is True:
+            sys.stdout.flush()
+
+
+def print_removed(path, group_list):
+    print("Removed {path}, {count} remaining in group".format(path=sanitize_object(path), count=len(group_list)))
+    print('')
+    sys.stdout.flush()
+
+
+def label_groups(filtered_groups, *, group_size):
+    for results in filtered_groups:
+        if len(results) >= group_size:
+            # Each group is labeled once, its filter output is no longer needed after
+            yield results, label_filters(filtered_groups.filter_hashes.pop(results[0]))
+
+
+def label_updates(streamed_groups, *, group_action):
+    # A group is given to the action once when found, and again with each file that joins it
+    source_first = getattr(group_action, 'source_first', False)
+    for results, start in streamed_groups:
+        labeled_filters = label_filters(streamed_groups.filter_hashes[results[0]])
+        if start > 0 and source_first is True:
+            yield [results[0]] + results[start:], labeled_filters
         else:
-            # Removes extra blank newlines
-            continue
+            yield results[start:], labeled_filters
+
+
+def label_filters(filter_hashes):
+    # Take each filters output and label f1: 1st_output, fn: n_output...
+    # Strip filter_output because of embedded newline
+    labeled_filters = OrderedDict()
+    for filter_number, filter_output in enumerate(filter_hashes):
+        labeled_filters["f{fn}".format(fn=filter_number + 1)] = filter_output.strip()
+    return labeled_filters
+
+
+def invoke_groups(labeled_groups, *, invocations, jobs):
+    # Runs up to jobs commands at once across groups, returning each group
+    # with the output of its commands once all of them are complete
+    queued_groups = deque()
+
+    def group_invocations():
+        for results, labeled_filters in labeled_groups:
+            group_calls = invocations(results, labeled_filters=labeled_filters)
+            queued_groups.append((results, len(group_calls)))
+            for group_call in group_calls:
+                yield group_call
+
+    outputs = list()
+    for output in ordered_map(lambda group_call: group_call(), group_invocations(), jobs=jobs):
+        outputs.append(output)
+        if len(outputs) == queued_groups[0][1]:
+            yield queued_groups.popleft()[0], outputs
+            outputs = list()
 
 
 if __name__ == '__main__':
@@ -2,21 +2,40 @@ import datetime
 import hashlib
 import logging
 import math
+import mmap
 import os
 import re
+import threading
+import zlib
 from collections import OrderedDict
 from collections import defaultdict
+from collections import deque
 from functools import partial
 
+from util.CachePolicy import open_file, read_ahead
+from util.CompactStore import CompactStore, GroupTable
+from util.DirectorySearch import FileRecord, HardLink, file_stat
+from util.FilterCache import CachedFilter
+from util.Parallel import batched_map, ordered_map
 from util.Templates import ActionAppendCreateFunc, \
     EscapedBraceExpansion
-from util.Templates import invoke_shell, sanitize_object
+from util.Templates import ShellCommandError, invoke_shell, sanitize_object
+from util.Watch import CREATED, DELETED, DELETED_TREE, OVERFLOW
 
 # This matches a newline, a space, tab, return character OR a null value: between the | and )
 _whitespace = re.compile('^([\n \t\r]|)+$')
 
 log = logging.getLogger(__name__)
 
+# Buffers are reused by each thread reading files
+_read_buffers = threading.local()
+_min_read_size = 131072
+# Blocks checksummed by the sample filter, each of _sample_block_size bytes
+_sample_count = 16
+_sample_block_size = 4096
+# Groups with more files than this are not all compared at once
+_max_open_files = 256
+
 
 class ActionSelectFilter(ActionAppendCreateFunc):
     def _process(self, template):
@@ -46,23 +65,87 @@ class OrderedDefaultListDict(OrderedDict):
         self[key] = value = []
         return value
 
+    def append(self, key, value):
+        self[key].append(value)
+
 
 class ActionAppendShellFilter(ActionAppendCreateFunc):
     @staticmethod
     def _process(template):
         template_format = EscapedBraceExpansion(template)
+        if template_format.batch is True:
+            shell_command = BatchShellFilter(template_format)
+            # Output is cached on the command rendered for each file
+            return CachedFilter(shell_command, spec=lambda filename: template_format([filename]))
         shell_command = partial(invoke_shell, command=template_format)
-        return shell_command
+        # Output is cached on the rendered command, as it may depend on the filename
+        return CachedFilter(shell_command, spec=template_format)
+
+
+class BatchShellFilter:
+    '''
+        A shell filter using {+}, run once for many files.
+        Its output is split into a result for each file, in the order given,
+        by NUL characters if any are output, otherwise by line
+    '''
+
+    def __init__(self, command):
+        self.command = command
+
+    def __repr__(self):
+        return '{cls}({command!r})'.format(cls=type(self).__name__, command=self.command.template)
+
+    def __call__(self, filename):
+        return self.batch([filename])[0]
+
+    def batch(self, filenames):
+        filenames = list(filenames)
+        output = invoke_shell(filenames, command=self.command)
+        if b'\0' in output:
+            outputs = output.split(b'\0')
+            if output.endswith(b'\0'):
+                outputs.pop()
+        else:
+            outputs = output.splitlines()
+
+        if len(outputs) != len(filenames):
+            msg = 'Command: "{cmd}" output {outputs} results for {files} files\n' \
+                  'Output: {output}'
+            raise ShellCommandError(msg.format(cmd=sanitize_object(self.command(filenames)),
+                                               outputs=len(outputs),
+                                               files=len(filenames),
+                                               output=sanitize_object(output)))
+        return outputs
 
 
 class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
+    # These read the contents of the file, their output is kept in the filter cache
+    content_filters = ("partial_md5", "head", "tail", "sample", "md5", "sha", "blake2b", "blake2s", "crc")
+
+    # These are called with a whole group, and return it split into groups
+    group_filters = ("compare",)
+
+    # Bytes read at once by content filters, by default taken from the st_blksize of each file
+    read_size = None
+    # Files of at least this many bytes are memory mapped instead of read
+    mmap_threshold = None
+    # How files read affect the page cache, one of CachePolicy.policies
+    cache_policy = 'keep'
+
     @classmethod
     def filters(cls):
         filters = OrderedDict(
             {
                 "partial_md5": cls.partial_md5_sum,
+                "head"       : cls.head_sum,
+                "tail"       : cls.tail_sum,
+                "sample"     : cls.sample_sum,
                 "md5"        : cls.md5_sum,
                 "sha"        : cls.sha_sum,
+                "blake2b"    : cls.blake2b_sum,
+                "blake2s"    : cls.blake2s_sum,
+                "crc"        : cls.crc_sum,
+                "compare"    : cls.compare_group,
                 "modified"   : cls.modification_date,
                 "accessed"   : cls.access_date,
                 "size"       : cls.disk_size,
@@ -75,14 +158,33 @@ class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
     def _process(cls, template):
         if "::" in template:
             func_name, abstraction = template.split("::", 1)
+            cls._check_modifier(func_name, abstraction)
             func_name = cls.filters()[func_name]
             filter_func = partial(func_name, abstraction=abstraction)
         else:
             func_name = template
             filter_func = cls.filters()[func_name]
 
+        if template.split("::", 1)[0] in cls.content_filters:
+            filter_func = CachedFilter(filter_func, spec=template)
+            # Reads the contents of each file, which may be scheduled by the device of the file
+            filter_func.reads_content = True
+        elif template.split("::", 1)[0] in cls.group_filters:
+            filter_func = GroupFilter(filter_func)
         return filter_func
 
+    # Modifiers of content filters are checked once here, rather than by each file read
+    @classmethod
+    def _check_modifier(cls, func_name, abstraction):
+        if func_name in ("head", "tail", "compare"):
+            cls._block_round(abstraction)
+        elif func_name == "sample":
+            cls._count_round(abstraction)
+        elif func_name == "blake2b":
+            cls._digest_round(abstraction, hashlib.blake2b.MAX_DIGEST_SIZE)
+        elif func_name == "blake2s":
+            cls._digest_round(abstraction, hashlib.blake2s.MAX_DIGEST_SIZE)
+
     # https://stackoverflow.com/a/14822210
     @classmethod
     def _size_round(cls, size_bytes, abstraction=None):
@@ -133,19 +235,95 @@ class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
         regex_pattern = re_match(filename, pattern=expr)
         return regex_pattern
 
-    # Used with checksum functions to reduce memory footprint
     @classmethod
-    def _iter_read(cls, filename: str, chunk_size=65536) -> bytes:
+    def _block_round(cls, abstraction=None) -> int:
+        if abstraction is None:
+            return 4096
+        try:
+            block_size = int(abstraction)
+            assert block_size > 0
+        except (ValueError, AssertionError):
+            log.error("Modifier {} is not a valid number of bytes".format(abstraction))
+            exit(1)
+        return block_size
+
+    @classmethod
+    def _count_round(cls, abstraction=None) -> int:
+        if abstraction is None:
+            return _sample_count
         try:
-            with open(filename, 'rb') as file:
-                for chunk in iter(lambda: file.read(chunk_size), b''):
-                    yield chunk
+            count = int(abstraction)
+            assert count > 0
+        except (ValueError, AssertionError):
+            log.error("Modifier {} is not a valid number of blocks".format(abstraction))
+            exit(1)
+        return count
+
+    @classmethod
+    def _digest_round(cls, abstraction, max_digest_size) -> int:
+        if abstraction is None:
+            return max_digest_size
+        try:
+            digest_size = int(abstraction)
+            assert 0 < digest_size <= max_digest_size
+        except (ValueError, AssertionError):
+            log.error("Modifier {} is not a valid digest size, from 1 to {}".format(abstraction, max_digest_size))
+            exit(1)
+        return digest_size
+
+    # Used with checksum functions, reads filename into a buffer reused for every read
+    # and passes each filled part of it to update, a negative start is relative to the end of the file
+    # Files of at least mmap_threshold bytes are memory mapped and passed to update at once
+    @classmethod
+    def _read_file(cls, filename: str, update, *, start=0, limit=None):
+        try:
+            stat = file_stat(filename)
+            with open_file(filename, cls.cache_policy) as file:
+                if start < 0:
+                    start = max(stat.st_size + start, 0)
+                if start > 0:
+                    file.seek(start)
+
+                if all((cls.mmap_threshold is not None,
+                        cls.cache_policy == 'keep',
+                        start == 0,
+                        limit is None,
+                        stat.st_size > 0,
+                        stat.st_size >= (cls.mmap_threshold or 0),
+                        )):
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        update(mapped)
+                    return None
+
+                buffer = cls._read_buffer(stat)
+                while limit is None or limit > 0:
+                    view = buffer if limit is None or limit >= len(buffer) else buffer[:limit]
+                    read_size = file.readinto(view)
+                    if not read_size:
+                        break
+                    update(view if read_size == len(view) else view[:read_size])
+                    if limit is not None:
+                        limit -= read_size
         except PermissionError:
             log.warning("Permission Denied for {}".format(filename))
 
+    # One buffer per thread, sized from read_size or the preferred block size of the file
+    @classmethod
+    def _read_buffer(cls, stat) -> memoryview:
+        if cls.read_size is not None:
+            buffer_size = cls.read_size
+        else:
+            block_size = getattr(stat, 'st_blksize', 0) or 4096
+            buffer_size = max(block_size, _min_read_size // block_size * block_size)
+        buffer = getattr(_read_buffers, 'buffer', None)
+        if buffer is None or len(buffer) < buffer_size:
+            buffer = memoryview(bytearray(buffer_size))
+            _read_buffers.buffer = buffer
+        return buffer[:buffer_size]
+
     @classmethod
     def access_date(cls, filename: str, *, abstraction=None) -> str:
-        access_time = os.path.getmtime(filename)
+        access_time = file_stat(filename).st_atime
         access_datetime = datetime.datetime.fromtimestamp(access_time)
         if abstraction is not None:
             access_datetime = cls._datetime_round(access_datetime, abstraction)
@@ -154,7 +332,7 @@ class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
 
     @classmethod
     def modification_date(cls, filename: str, *, abstraction=None) -> str:
-        modification_time = os.path.getmtime(filename)
+        modification_time = file_stat(filename).st_mtime
         modified_datetime = datetime.datetime.fromtimestamp(modification_time)
         if abstraction is not None:
             modified_datetime = cls._datetime_round(modified_datetime, abstraction)
@@ -170,21 +348,65 @@ class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
 
     @classmethod
     def disk_size(cls, filename: str, *, abstraction=None) -> str:
-        byte_usage = os.path.getsize(filename)
+        byte_usage = file_stat(filename).st_size
         if abstraction is not None:
             byte_usage = cls._size_round(byte_usage, abstraction=abstraction)
         return str(byte_usage)
 
     @classmethod
-    def md5_sum(cls, filename, *, chunk_size=65536) -> str:
+    def md5_sum(cls, filename) -> str:
         checksumer = hashlib.md5()
-        for chunk in cls._iter_read(filename, chunk_size):
-            checksumer.update(chunk)
+        cls._read_file(filename, checksumer.update)
         file_hash = checksumer.hexdigest()
         return str(file_hash)
 
     @classmethod
-    def sha_sum(cls, filename, *, chunk_size=65536, abstraction=None) -> str:
+    def head_sum(cls, filename, *, abstraction=None) -> str:
+        block_size = cls._block_round(abstraction)
+        checksumer = hashlib.md5()
+        cls._read_file(filename, checksumer.update, limit=block_size)
+        return checksumer.hexdigest()
+
+    @classmethod
+    def tail_sum(cls, filename, *, abstraction=None) -> str:
+        block_size = cls._block_round(abstraction)
+        checksumer = hashlib.md5()
+        cls._read_file(filename, checksumer.update, start=-block_size)
+        return checksumer.hexdigest()
+
+    # md5 checksum of count blocks spread evenly across the file, and its last block
+    # The size is checksummed first, so files of different sizes never match by their samples
+    # A file no larger than the blocks sampled is read in full
+    @classmethod
+    def sample_sum(cls, filename, *, abstraction=None) -> str:
+        count = cls._count_round(abstraction)
+        checksumer = hashlib.md5()
+        stat = file_stat(filename)
+        checksumer.update('{}\0'.format(stat.st_size).encode())
+        if stat.st_size <= _sample_block_size * (count + 1):
+            cls._read_file(filename, checksumer.update)
+            return checksumer.hexdigest()
+
+        last_offset = stat.st_size - _sample_block_size
+        offsets = [last_offset * block // count for block in range(count)] + [last_offset]
+        buffer = cls._read_buffer(stat)[:_sample_block_size]
+        try:
+            with open_file(filename, cls.cache_policy) as file:
+                for offset in offsets:
+                    file.seek(offset)
+                    filled = 0
+                    while filled < len(buffer):
+                        read_size = file.readinto(buffer[filled:])
+                        if not read_size:
+                            break
+                        filled += read_size
+                    checksumer.update(buffer[:filled])
+        except PermissionError:
+            log.warning("Permission Denied for {}".format(filename))
+        return checksumer.hexdigest()
+
+    @classmethod
+    def sha_sum(cls, filename, *, abstraction=None) -> str:
         sha_levels = {
             '1': hashlib.sha1,
             '224': hashlib.sha224,
@@ -200,20 +422,107 @@ class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
             checksumer = sha_levels[abstraction]()
         else:
             checksumer = sha_levels['256']()
-        for chunk in cls._iter_read(filename, chunk_size):
-            checksumer.update(chunk)
+        cls._read_file(filename, checksumer.update)
         file_hash = checksumer.hexdigest()
         return str(file_hash)
 
+    @classmethod
+    def blake2b_sum(cls, filename, *, abstraction=None) -> str:
+        digest_size = cls._digest_round(abstraction, hashlib.blake2b.MAX_DIGEST_SIZE)
+        checksumer = hashlib.blake2b(digest_size=digest_size)
+        cls._read_file(filename, checksumer.update)
+        return checksumer.hexdigest()
+
+    @classmethod
+    def blake2s_sum(cls, filename, *, abstraction=None) -> str:
+        digest_size = cls._digest_round(abstraction, hashlib.blake2s.MAX_DIGEST_SIZE)
+        checksumer = hashlib.blake2s(digest_size=digest_size)
+        cls._read_file(filename, checksumer.update)
+        return checksumer.hexdigest()
+
+    # Not a cryptographic checksum, crc32 and adler32 are both computed in one read
+    # and combined to make collisions less likely
+    @classmethod
+    def crc_sum(cls, filename) -> str:
+        checksums = [zlib.crc32(b''), zlib.adler32(b'')]
+
+        def update(chunk):
+            checksums[0] = zlib.crc32(chunk, checksums[0])
+            checksums[1] = zlib.adler32(chunk, checksums[1])
+
+        cls._read_file(filename, update)
+        return "{:08x}{:08x}".format(*checksums)
+
+    # Reads every file of the same size in lockstep, splitting the group at the first
+    # block that differs. A file is no longer read once no other file matches it
+    @classmethod
+    def compare_group(cls, group, *, abstraction=None) -> list:
+        max_block_size = cls._block_round(abstraction) if abstraction is not None else 1048576
+
+        size_groups = OrderedDefaultListDict()
+        for item in group:
+            try:
+                size_groups[file_stat(item).st_size].append(item)
+            except OSError as e:
+                log.warning("Unable to read {file}: {err}".format(file=sanitize_object(item), err=e.strerror))
+        compared_groups = list()
+        for size_group in size_groups.values():
+            if len(size_group) == 1:
+                compared_groups.append(size_group)
+            elif len(size_group) <= _max_open_files:
+                compared_groups.extend(cls._lockstep(size_group, max_block_size))
+            else:
+                # Too many to open at once, compare each file against the first of every group found so far
+                matched_groups = list()
+                for item in size_group:
+                    for matched_group in matched_groups:
+                        if len(cls._lockstep([matched_group[0], item], max_block_size)) == 1:
+                            matched_group.append(item)
+                            break
+                    else:
+                        matched_groups.append([item])
+                compared_groups.extend(matched_groups)
+        return compared_groups
+
     @staticmethod
-    def partial_md5_sum(filename, chunk_size=65536, chunks_read=200) -> str:
+    def _lockstep(paths, max_block_size) -> list:
+        opened = list()
+        compared_groups = list()
+        for path in paths:
+            try:
+                opened.append((path, open_file(path, ActionAppendFilePropertyFilter.cache_policy)))
+            except OSError as e:
+                log.warning("Unable to read {file}: {err}".format(file=sanitize_object(path), err=e.strerror))
+
+        # Blocks read start small, as files that differ usually do so early on
+        pending = [(opened, 4096)]
+        try:
+            while pending:
+                members, block_size = pending.pop()
+                blocks = OrderedDefaultListDict()
+                for path, file in members:
+                    blocks[file.read(block_size)].append((path, file))
+
+                next_block_size = min(block_size * 2, max_block_size)
+                for block, block_members in blocks.items():
+                    if len(block_members) == 1 or block == b'':
+                        for path, file in block_members:
+                            file.close()
+                        compared_groups.append([path for path, file in block_members])
+                    else:
+                        pending.append((block_members, next_block_size))
+        finally:
+            for path, file in opened:
+                file.close()
+
+        # Returned in the order of paths
+        order = {path: number for number, path in enumerate(paths)}
+        return sorted(compared_groups, key=lambda compared_group: order[compared_group[0]])
+
+    @classmethod
+    def partial_md5_sum(cls, filename, chunk_size=65536, chunks_read=200) -> str:
         checksumer = hashlib.md5()
-        with open(filename, 'rb') as file:
-            for null in range(0, chunks_read):
-                chunk = file.read(chunk_size)
-                if chunk == b'':
-                    break
-                checksumer.update(chunk)
+        cls._read_file(filename, checksumer.update, limit=chunk_size * chunks_read)
         return checksumer.hexdigest()
 
     @classmethod
@@ -309,11 +618,44 @@ class ActionAppendFilePropertyFilter(ActionAppendCreateFunc):
             return datetime_round
 
 
+# Path with its directory resolved, a symbolic link itself is kept
+def _real_path(path):
+    directory, filename = os.path.split(path)
+    return os.path.join(os.path.realpath(directory), filename)
+
+
+class GroupFilter:
+    '''
+        Wraps a filter that is called with a whole group,
+        returning a list of the groups it is split into
+    '''
+
+    def __init__(self, func):
+        self.func = func
+
+    def __repr__(self):
+        return '{cls}({func!r})'.format(cls=type(self).__name__, func=self.func)
+
+    def __call__(self, group):
+        return self.func(group)
+
+
 class DuplicateFilters:
-    def __init__(self, *, filters, filenames, conditions=None):
+    def __init__(self, *, filters, filenames, conditions=None, jobs=1, group_size=1, verify=False,
+                 batch_size=100, overlapping=False, scheduler=None):
         self.filters = filters
         self.filenames = filenames
         self.filter_hashes = defaultdict(list)
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.group_size = group_size
+        self.verify = verify
+        # The directories searched overlap, the same file may be found by two paths
+        self.overlapping = overlapping
+        # Item of the first path found to a file -> the other paths to it, which are not filtered
+        self.links = dict()
+        # Reads the files of content filters with a queue for each device, if given
+        self.scheduler = scheduler
         if conditions is None:
             self.conditions = list()
         else:
@@ -326,63 +668,174 @@ class DuplicateFilters:
         initial_filter, *other_filters = self.filters
         results = self._first_filter(initial_filter, self.filenames, conditions=self.conditions)
         for additional_filter in other_filters:
-            results = self._additional_filters(additional_filter, results)
-        for group_list in results:
-            yield group_list
+            if isinstance(additional_filter, GroupFilter):
+                results = self._additional_group_filter(additional_filter, self._prune(results))
+            else:
+                results = self._additional_filters(additional_filter, self._prune(results))
+        if self.verify is True:
+            results = self._verify_groups(self._prune(results))
+        for group_list in self._prune(results):
+            yield self._group_paths(group_list)
 
-    def _first_filter(self, func, paths, conditions):
-        grouped_groups = OrderedDefaultListDict()
+    def _group_paths(self, group_list):
+        # Paths of the group, each followed by the other paths to the same file
+        group_paths = list()
+        for item in group_list:
+            path = self._path(item)
+            group_paths.append(path)
+            for link in self.links.pop(item, ()):
+                group_paths.append(HardLink(link, path))
+        return group_paths
+
+    def _verify_groups(self, groups):
+        # Compares the contents of every file in each group, splitting the group
+        # into files that are byte for byte the same
+        compare = partial(self._call_group, ActionAppendFilePropertyFilter.compare_group)
+        for group_list, verified_groups in ordered_map(lambda group_list: (group_list, compare(group_list)),
+                                                       groups, jobs=self.jobs):
+            if len(verified_groups) > 1:
+                log.warning("{file} matched {count} files with different contents".format(
+                    file=sanitize_object(self._path(group_list[0])),
+                    count=len(group_list) - len(verified_groups[0])))
+            for verified_group in verified_groups:
+                yield verified_group
+
+    def _prune(self, groups):
+        # Filters only ever split a group, so a group smaller than group_size
+        # is dropped before any further filter is run on its files
+        for group_list in groups:
+            group_size = len(group_list)
+            if self.links:
+                group_size += sum(len(self.links.get(item, ())) for item in group_list)
+            if group_size >= self.group_size:
+                yield group_list
+            else:
+                for item in group_list:
+                    self._forget(item)
+                    self.links.pop(item, None)
+
+    # Files are kept as items, the path itself unless stored more compactly
+    def _item(self, path):
+        return path
+
+    def _path(self, item):
+        return item
+
+    def _record_hash(self, item, item_hash):
+        # Returns the key the item is grouped by
+        self.filter_hashes[item].append(item_hash)
+        return item_hash
+
+    def _forget(self, item):
+        self.filter_hashes.pop(item, None)
+
+    def _group_table(self):
+        return OrderedDefaultListDict()
+
+    def _call_group(self, func, group_list):
+        return func(group_list)
+
+    def _items(self, paths, conditions):
+        # Each file is filtered once, by the first path found to it
+        # Other hard links to it are kept in self.links, the same path found again is dropped
+        files = dict()
         for path in paths:
-            if all(condition(path) for condition in conditions):
-                item_hash = func(path).strip()
+            if not all(condition(path) for condition in conditions):
+                continue
+            file_key = self._file_key(path)
+            if file_key is None:
+                yield self._item(path)
+                continue
+            item = files.get(file_key)
+            if item is None:
+                item = files[file_key] = self._item(path)
+                yield item
+                continue
+            source = self._path(item)
+            links = self.links.get(item, ())
+            real_path = _real_path(path)
+            if any(real_path == _real_path(found) for found in [source, *links]):
+                log.debug("{path} found again".format(path=sanitize_object(path)))
+            else:
+                log.debug("{path} is a hard link of {source}".format(path=sanitize_object(path),
+                                                                     source=sanitize_object(source)))
+                self.links.setdefault(item, list()).append(path)
+
+    def _file_key(self, path):
+        # Identifies the file at path, if it may be found by another path
+        try:
+            stat = file_stat(path)
+        except OSError:
+            return None
+        if stat.st_nlink < 2 and self.overlapping is False:
+            return None
+        # A symbolic link is filtered as its own file, as without following links
+        # A FileRecord knows from the listing of its directory, without another lstat
+        is_symlink = path.is_symlink() if isinstance(path, FileRecord) else os.path.islink(path)
+        if is_symlink:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def _first_filter(self, func, paths, conditions):
+        grouped_groups = self._group_table()
+        items = self._items(paths, conditions)
+        # Every path found is a single group for a group filter
+        if isinstance(func, GroupFilter):
+            for group_list in self._additional_group_filter(func, [list(items)]):
+                yield group_list
+            return None
+
+        for item, item_hash in self._map(func, items):
+            item_hash = item_hash.strip()
+            if log.isEnabledFor(logging.DEBUG):
+                path = self._path(item)
                 log.debug("{path}:{spaces} {hash}".format(
                     path=sanitize_object(path),
                     spaces=' ' * (50 - len(sanitize_object(path))),
                     hash=sanitize_object(item_hash)))
 
-                # If matching _whitespace or length of 0, continue since it shouldn't be
-                # considered a valid output, however will only check for values less then 10 (for performance)
-                if len(item_hash) < 10:
-                    if len(item_hash) == 0:
-                        continue
-                    elif _whitespace.match(str(item_hash)):
-                        continue
+            # If matching _whitespace or length of 0, continue since it shouldn't be
+            # considered a valid output, however will only check for values less then 10 (for performance)
+            if len(item_hash) < 10:
+                if len(item_hash) == 0:
+                    continue
+                elif _whitespace.match(str(item_hash)):
+                    continue
 
-                self.filter_hashes[path].append(item_hash)
-                grouped_groups[item_hash].append(path)
-        for key, group in grouped_groups.items():
+            grouped_groups.append(self._record_hash(item, item_hash), item)
+        for group in grouped_groups.values():
             if len(group) > 0:
                 # key is appended enclosed in a list to group it, allowing other filters to also append to that
                 # specific group
                 yield group
 
     def _additional_filters(self, func, groups):
-        for group_list in groups:
+        for group_list, group_hashes in self._map_groups(func, groups):
             unmatched_groups = OrderedDefaultListDict()
             filtered_groups = list()
-            if len(group_list) > 0:
-                first, *others = group_list
-                filtered_groups.append(first)
-                source_hash = func(first).strip()
-                self.filter_hashes[first].append(source_hash)
-
-                for item in others:
-                    item_hash = func(item).strip()
-
-                    # If matching _whitespace, continue since it shouldn't be considered a valid
-                    # output, however will only check for values less then 10 (for performance)
-                    if len(item_hash) < 10:
-                        if len(item_hash) == 0:
-                            continue
-                        elif _whitespace.match(str(item_hash)):
-                            continue
-
-                    self.filter_hashes[item].append(item_hash)
-                    # If this item matches the source, include it in the list to be returned.
-                    if item_hash == source_hash:
-                        filtered_groups.append(item)
-                    else:
-                        unmatched_groups[item_hash].append(item)
+            first, *others = group_list
+            source_hash, *other_hashes = group_hashes
+            filtered_groups.append(first)
+            source_hash = source_hash.strip()
+            self._record_hash(first, source_hash)
+
+            for item, item_hash in zip(others, other_hashes):
+                item_hash = item_hash.strip()
+
+                # If matching _whitespace, continue since it shouldn't be considered a valid
+                # output, however will only check for values less then 10 (for performance)
+                if len(item_hash) < 10:
+                    if len(item_hash) == 0:
+                        continue
+                    elif _whitespace.match(str(item_hash)):
+                        continue
+
+                self._record_hash(item, item_hash)
+                # If this item matches the source, include it in the list to be returned.
+                if item_hash == source_hash:
+                    filtered_groups.append(item)
+                else:
+                    unmatched_groups[item_hash].append(item)
 
             yield filtered_groups
             # Calls itself on all unmatched groups
@@ -391,6 +844,346 @@ class DuplicateFilters:
                     log.debug("Subgroup")
                     yield unmatched_group
 
+    # Each group the filter returns is labeled by its position, 1 for the first group
+    def _additional_group_filter(self, func, groups):
+        for split_groups in ordered_map(partial(self._call_group, func), groups, jobs=self.jobs):
+            for group_number, group_list in enumerate(split_groups, 1):
+                for item in group_list:
+                    self._record_hash(item, str(group_number))
+                yield group_list
+
+    def _map(self, func, items):
+        # Each item is returned with its filter output, in the order of items
+        # Filters able to take many files at once are called with batches of them
+        if getattr(func, 'batch', None) is not None:
+            return batched_map(lambda batch: func.batch([self._path(item) for item in batch]),
+                               items, size=self.batch_size, jobs=self.jobs)
+        if self.scheduler is not None and getattr(func, 'reads_content', False) is True:
+            return self.scheduler.map(lambda item: (item, func(self._path(item))), items,
+                                      path=self._path, stat=file_stat)
+        if getattr(func, 'reads_content', False) is True:
+            items = self._read_ahead(func, items)
+        return ordered_map(lambda item: (item, func(self._path(item))), items, jobs=self.jobs)
+
+    def _read_ahead(self, func, items):
+        # Each item is given once the next item has been hinted to the kernel,
+        # so the start of the next file is read while the current file is filtered
+        policy = ActionAppendFilePropertyFilter.cache_policy
+        if policy not in ('readahead', 'drop'):
+            for item in items:
+                yield item
+            return None
+        pending = deque()
+        for item in items:
+            path = self._path(item)
+            if not func.cached(path):
+                read_ahead(path, policy)
+            pending.append(item)
+            if len(pending) > 1:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def _map_groups(self, func, groups):
+        # Calls func on every member of each group, spread across self.jobs threads
+        # Each group is returned with a list of its filter output, in the order of groups
+        queued_groups = deque()
+
+        def members():
+            for group_list in groups:
+                if len(group_list) > 0:
+                    queued_groups.append(group_list)
+                    for item in group_list:
+                        yield item
+
+        group_hashes = list()
+        for item, item_hash in self._map(func, members()):
+            group_hashes.append(item_hash)
+            if len(group_hashes) == len(queued_groups[0]):
+                yield queued_groups.popleft(), group_hashes
+                group_hashes = list()
+
+
+class CompactDuplicateFilters(DuplicateFilters):
+    '''
+        DuplicateFilters keeping paths and filter output in a CompactStore,
+        for searches of many millions of files.
+        Files are handled by their id, groups are turned back into paths once complete
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.store = CompactStore()
+
+    def _group_paths(self, group_list):
+        # Only the output of the first file is kept as a string, for labeling the group
+        group_paths = super()._group_paths(group_list)
+        self.filter_hashes[group_paths[0]] = self.store.outputs(group_list[0])
+        return group_paths
+
+    def _item(self, path):
+        # The stat found while searching is kept, so later filters don't stat the file again
+        try:
+            stat = file_stat(path)
+        except OSError:
+            stat = None
+        return self.store.add(path, stat=stat)
+
+    def _path(self, item):
+        path = FileRecord(self.store.path(item))
+        stat = self.store.stat(item)
+        if stat is not None:
+            path._stat = stat
+        return path
+
+    def _record_hash(self, item, item_hash):
+        return self.store.append_output(item, item_hash)
+
+    def _forget(self, item):
+        pass
+
+    def _group_table(self):
+        return GroupTable()
+
+    def _call_group(self, func, group_list):
+        # Group filters are given paths, the groups returned are turned back into ids
+        items = {self.store.path(item): item for item in group_list}
+        return [[items[path] for path in split_group] for split_group in func(list(items))]
+
+
+class StreamingFilters(DuplicateFilters):
+    '''
+        Groups paths as they arrive, for a stream of paths that may never end.
+        Yields a group each time a path joins it, with the index of the first new path.
+        Later filters are only run on a path once another path has matched it so far,
+        so a path unique by its first filter is not read any further.
+        Only max_singletons of these unmatched paths are kept, the oldest are forgotten.
+        Only max_groups groups, and outputs so far matched by more than one path, are kept,
+        those least recently joined are forgotten
+    '''
+
+    def __init__(self, *, max_singletons=None, max_groups=None, **kwargs):
+        super().__init__(**kwargs)
+        self.max_singletons = max_singletons
+        self.max_groups = max_groups
+        self.evicted = 0
+        # Filter output so far of a path no other path has matched -> that path, oldest first
+        self._singletons = OrderedDict()
+        # Filter output so far matched by two or more paths, least recently matched first
+        self._expanded = OrderedDict()
+        # Output of every filter -> paths in the group, least recently joined first
+        self._groups = OrderedDict()
+        # Output of every filter -> the same paths as a set, to find a path given again
+        self._members = dict()
+
+    def process(self):
+        if any(isinstance(func, GroupFilter) for func in self.filters):
+            log.error("Group filters such as compare can not be used when streaming")
+            exit(1)
+
+        for path in self.filenames:
+            for group_list, start in self.add(path):
+                yield group_list, start
+
+    def add(self, path) -> list:
+        # Returns each group the path joins, as (group, index of the first new path)
+        if not all(condition(path) for condition in self.conditions):
+            return list()
+        # Groups returned by the last path have been acted on, so may be forgotten
+        self._evict_groups()
+        key = self._next_key(path, tuple())
+        if key is None:
+            return list()
+        return self._insert(path, key)
+
+    def _next_key(self, path, key):
+        # Runs the next filter on path, returning key with its output added
+        # Returns None for an output that shouldn't be considered valid
+        func = self.filters[len(key)]
+        item_hash = func(path).strip()
+        log.debug("{path}:{spaces} {hash}".format(
+            path=sanitize_object(path),
+            spaces=' ' * (50 - len(sanitize_object(path))),
+            hash=sanitize_object(item_hash)))
+        if len(item_hash) < 10:
+            if len(item_hash) == 0:
+                return None
+            elif _whitespace.match(str(item_hash)):
+                return None
+        return key + (item_hash,)
+
+    def _insert(self, path, key):
+        updates = list()
+        pending = [(path, key)]
+        while pending:
+            path, key = pending.pop()
+            if len(key) == len(self.filters):
+                updates.extend(self._join(path, key))
+            # Every path is its own group with a group size of 1, run every filter
+            elif key in self._expanded or self.group_size <= 1:
+                if key in self._expanded:
+                    self._expanded.move_to_end(key)
+                next_key = self._next_key(path, key)
+                if next_key is not None:
+                    pending.append((path, next_key))
+            elif key in self._singletons:
+                # Both paths are run through the next filter, the earlier path first
+                earlier_path = self._singletons.pop(key)
+                self._expanded[key] = None
+                pending.append((path, key))
+                pending.append((earlier_path, key))
+            else:
+                self._singletons[key] = path
+                self._placed(path, key)
+                if self.max_singletons is not None and len(self._singletons) > self.max_singletons:
+                    self._forget(self._singletons.popitem(last=False)[1])
+                    self.evicted += 1
+        return updates
+
+    def _evict_groups(self):
+        if self.max_groups is None:
+            return None
+        while len(self._expanded) > self.max_groups:
+            self._expanded.popitem(last=False)
+        while len(self._groups) > self.max_groups:
+            key, group_list = self._groups.popitem(last=False)
+            del self._members[key]
+            for path in group_list:
+                self._forget(path)
+            self.filter_hashes.pop(group_list[0], None)
+            self.evicted += 1
+
+    # Called with the key a path is kept under, as a singleton or in a group
+    def _placed(self, path, key):
+        pass
+
+    def _join(self, path, key):
+        group_list = self._groups.setdefault(key, list())
+        members = self._members.setdefault(key, set())
+        self._groups.move_to_end(key)
+        # The same path given again
+        if path in members:
+            return list()
+        if self.verify is True and group_list:
+            compared_groups = ActionAppendFilePropertyFilter.compare_group([group_list[0], path])
+            if len(compared_groups) > 1:
+                log.warning("{file} matched {source} with different contents".format(
+                    file=sanitize_object(path),
+                    source=sanitize_object(group_list[0])))
+                return list()
+
+        group_list.append(path)
+        members.add(path)
+        self._placed(path, key)
+        if len(group_list) == 1:
+            self.filter_hashes[path] = list(key)
+
+        if len(group_list) < self.group_size:
+            return list()
+        elif len(group_list) == max(self.group_size, 1):
+            return [(group_list, 0)]
+        else:
+            return [(group_list, len(group_list) - 1)]
+
+
+class WatchedFilters(StreamingFilters):
+    '''
+        StreamingFilters that keep grouping the files written, moved or deleted
+        once the filenames are used up, from the events of watcher.
+        searched decides if a file written is included, search() finds every file again
+        when events are lost. removed is called with each path removed from a group
+    '''
+
+    def __init__(self, *, watcher, search, searched=None, removed=None, **kwargs):
+        super().__init__(**kwargs)
+        self.watcher = watcher
+        self.search = search
+        self.searched = searched
+        self.removed = removed
+        # Path -> the key it is kept under
+        self._paths = dict()
+
+    def process(self):
+        for update in super().process():
+            yield update
+
+        for event, path in self.watcher:
+            if event == CREATED:
+                if self.searched is None or self.searched(path):
+                    for update in self.update(FileRecord(path)):
+                        yield update
+            elif event == DELETED:
+                self._removed(path)
+            elif event == DELETED_TREE:
+                prefix = os.path.join(path, '')
+                for file in self.paths():
+                    if file.startswith(prefix):
+                        self._removed(file)
+            elif event == OVERFLOW:
+                found = set()
+                for file in self.search():
+                    found.add(file)
+                    for update in self.update(file):
+                        yield update
+                for file in self.paths():
+                    if file not in found:
+                        self._removed(file)
+
+    def _removed(self, path):
+        group_list = self.discard(path)
+        if group_list is not None and self.removed is not None:
+            self.removed(path, group_list)
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def paths(self):
+        return list(self._paths)
+
+    def _placed(self, path, key):
+        self._paths[path] = key
+
+    def _forget(self, path):
+        self._paths.pop(path, None)
+
+    def update(self, path) -> list:
+        # The file may have changed, it is removed and filtered again
+        self._removed(path)
+        try:
+            return self.add(path)
+        except OSError as e:
+            log.warning("Unable to read {file}: {err}".format(file=sanitize_object(path), err=e.strerror))
+            self.discard(path)
+            return list()
+
+    def discard(self, path):
+        # Returns the group the path was removed from, if the group had been found
+        key = self._paths.pop(path, None)
+        if key is None:
+            return None
+        if self._singletons.get(key) == path:
+            del self._singletons[key]
+            return None
+
+        # A singleton filtered further without joining a group is no longer kept
+        group_list = self._groups.get(key)
+        if group_list is None or path not in self._members[key]:
+            return None
+
+        group_found = len(group_list) >= max(self.group_size, 1)
+        group_list.remove(path)
+        self._members[key].discard(path)
+        if not group_list:
+            del self._groups[key]
+            del self._members[key]
+            self.filter_hashes.pop(path, None)
+        elif path in self.filter_hashes:
+            # The group is labeled by its first path
+            self.filter_hashes[group_list[0]] = self.filter_hashes.pop(path)
+        if group_found:
+            return group_list
+        return None
+
 
 if __name__ == '__main__':
     pass
@@ -1,10 +1,13 @@
-import datetime
 import logging
 import os
 import pprint
-import shutil
 from functools import partial
 
+from util.BatchOperations import batch, link_operation, number_operations, remove_operation
+from util.BatchOperations import run as run_operations
+from util.CopyEngine import CopyEngine
+from util.DirectorySearch import HardLink
+from util.MergePlanner import MergePlanner, overwrite_modifiers
 from util.Templates import ActionAppendCreateFunc
 from util.Templates import EscapedBraceExpansion
 from util.Templates import invoke_shell
@@ -25,7 +28,11 @@ def print_results(filtered_group, *, basic_formatting=False, labeled_filters):
         if len(group) > 0:
             for filename in group:
                 padding = len(filename) + 4
-                yield filename.rjust(padding) + '\n'
+                # Paths already linked to the same file as another in the group are marked
+                if isinstance(filename, HardLink):
+                    yield filename.rjust(padding) + '  (hard link of {})\n'.format(filename.source)
+                else:
+                    yield filename.rjust(padding) + '\n'
 
 
 class ActionAppendExecShell(ActionAppendCreateFunc):
@@ -33,77 +40,102 @@ class ActionAppendExecShell(ActionAppendCreateFunc):
         command_template_format = EscapedBraceExpansion(template)
 
         shell_command = partial(self._group_invoke_shell, command=command_template_format)
+        # Allows the commands of many groups to be run at once
+        shell_command.invocations = partial(self._group_invocations, command=command_template_format)
         return shell_command
 
+    @classmethod
+    def _group_invoke_shell(cls, filtered_group, command, labeled_filters, **kwargs):
+        for invocation in cls._group_invocations(filtered_group, command, labeled_filters, **kwargs):
+            yield invocation()
+
+    # Each command to run for the group, called without arguments returns its sanitized output
     @staticmethod
-    def _group_invoke_shell(filtered_group, command, labeled_filters, **kwargs):
-        for file in filtered_group:
-            output = invoke_shell(file, command=command, labeled_filters=labeled_filters, **kwargs)
-            output = sanitize_object(output)
-            yield output
+    def _group_invocations(filtered_group, command, labeled_filters, **kwargs) -> list:
+        def invocation(files):
+            output = invoke_shell(files, command=command, labeled_filters=labeled_filters, **kwargs)
+            return sanitize_object(output)
+
+        # With {+}, the command is run once with every file in the group
+        if command.batch is True:
+            return [partial(invocation, list(filtered_group))]
+        return [partial(invocation, file) for file in filtered_group]
 
 
 def remove_files(filtered_group: iter, labeled_filters, **kwargs):
-    files_to_remove = filtered_group[1:]
-    if len(files_to_remove) > 0:
+    source_file, *files_to_remove = filtered_group
+    # Another path to the source itself is never removed, it would remove the only copy
+    files_to_remove = [filename for filename in files_to_remove if not _same_file(source_file, filename)]
+    operations = _group_operations(remove_operation, source_file, files_to_remove)
+    if batch.enabled is True:
+        batch.add(operations)
+        return None
+    if len(operations) > 0:
         warning_message = "Are you sure you wish to remove and hard link the following duplicate files?"
         print(warning_message)
-        pprint.pprint(files_to_remove)
+        pprint.pprint([operation['path'] for operation in operations])
         warning_response = input("Y/N ").upper()
 
         if warning_response and warning_response != 'Y':
             print('Exiting...')
             exit(1)
 
-        for filename in files_to_remove:
-            try:
-                log.info("Removing {file}".format(file=sanitize_object(filename)))
-                os.remove(filename)
-            except FileNotFoundError:
-                log.warning("{} Not Found".format(sanitize_object(filename)))
-        return None
-    else:
-        return None
+        run_operations(number_operations([operations]))
+    return None
 
 
 def hardlink_files(filtered_group: iter, labeled_filters, **kwargs):
     source_file, *files_to_link = filtered_group
-    if len(files_to_link) > 0:
+    # Files already hard linked to the source are left as they are
+    files_to_link = [filename for filename in files_to_link if not _same_file(source_file, filename)]
+    operations = _group_operations(link_operation, source_file, files_to_link)
+    if batch.enabled is True:
+        batch.add(operations)
+        return None
+    if len(operations) > 0:
         warning_message = "Are you sure you wish to remove and hard link the following duplicate files?"
         print(warning_message)
-        pprint.pprint(files_to_link)
+        pprint.pprint([operation['path'] for operation in operations])
         warning_response = input("Y/N ").upper()
 
         if warning_response and warning_response != 'Y':
             print('Exiting...')
             exit(1)
 
-    for filename in files_to_link:
-        try:
-            log.info("Linking {source_file} -> {filename}".format(
-                source_file=sanitize_object(source_file),
-                filename=sanitize_object(filename)))
-            os.remove(filename)
-            os.link(source_file, filename)
-        except FileNotFoundError:
-            log.warning("{} Not Found".format(sanitize_object(filename)))
+        run_operations(number_operations([operations]))
     return None
 
 
+def _group_operations(operation, source_file, filenames) -> list:
+    # The stat of each file is kept, so a file changed before the operation is made is left as it is
+    operations = list()
+    for filename in filenames:
+        try:
+            operations.append(operation(source_file, filename))
+        except FileNotFoundError as e:
+            log.warning("{} Not Found".format(sanitize_object(e.filename)))
+    return operations
+
+
+def _same_file(source_file, filename):
+    try:
+        return os.path.samefile(source_file, filename)
+    except OSError:
+        return False
+
+
+# When streaming, actions marked with source_first are given the first file of the group
+# along with the new files, other actions are only given the new files
+print_results.source_first = True
+remove_files.source_first = True
+hardlink_files.source_first = True
+
+
 class ActionAppendMerge(ActionAppendCreateFunc):
-    @classmethod
-    def overwrite_flags(cls):
-        flags = {
-            "COUNT": cls._count,
-            "IGNORE": cls._ignore,
-            "ERROR": cls._error,
-
-            "LARGER": partial(cls._condition, condition='LARGER'),
-            "SMALLER": partial(cls._condition, condition='SMALLER'),
-            "NEWER": partial(cls._condition, condition='NEWER'),
-            "OLDER": partial(cls._condition, condition='OLDER'),
-            }
-        return flags
+    # Puts each file in the merge directory, set from --merge-mode and --jobs
+    engine = CopyEngine()
+    # Set from --dry-run, the plan is printed in place of merging
+    dry_run = False
 
     def _process(self, template):
         mergedir_flag = template
@@ -117,134 +149,30 @@ class ActionAppendMerge(ActionAppendCreateFunc):
             overwrite_flag = None
 
         if overwrite_flag is not None:
-            try:
-                overwrite_method = self.overwrite_flags()[overwrite_flag.upper()]
-            except KeyError as e:
-                log.error('{} is not a valid key'.format(e))
+            if overwrite_flag.upper() not in overwrite_modifiers:
+                log.error('{} is not a valid key'.format(repr(overwrite_flag.upper())))
                 exit(1)
+            overwrite = overwrite_flag.upper()
         else:
-            overwrite_method = self._count
+            overwrite = 'COUNT'
 
+        # Created with the first group merged, so nothing is written with --dry-run
         if os.path.exists(merge_dir):
             log.error("{} already exists".format(sanitize_object(merge_dir)))
             exit(1)
-        else:
-            os.makedirs(merge_dir)
 
         callable_ = partial(self._abstract_call,
-                            merge_dir=merge_dir,
-                            overwrite_method=overwrite_method)
+                            planner=MergePlanner(merge_dir, overwrite=overwrite))
         return callable_
 
     @staticmethod
-    def _abstract_call(filtered_group, *, merge_dir, overwrite_method, labeled_filters):
-        filter_dir = os.path.join(merge_dir, *labeled_filters.values())
-        os.makedirs(filter_dir)
-        output = overwrite_method(filter_dir, filter_group=filtered_group)
-        return output
-
-    @staticmethod
-    def _count(filter_dir, filter_group):
-        # This keeps the left padding of 0's
-        def incr_count(count):
-            return str(int(count) + 1).zfill(len(count))
-
-        def create_file_path(dir_, filename, count=None, fileext=None):
-            if count is not None:
-                filename = '_'.join([filename, count])
-            if fileext is not None:
-                filename = ''.join([filename + fileext])
-            dest_dir_file = os.path.join(dir_, filename)
-            return dest_dir_file
-
-        for file in filter_group:
-            filename = os.path.split(file)[1]
-            filename_split = os.path.splitext(filename)
-
-            dest_dir_file = os.path.join(filter_dir, filename)
-            if os.path.exists(dest_dir_file):
-                count = '0000'
-                dest_dir = filter_dir
-                dest_dir_file = create_file_path(dest_dir, filename)
-                while os.path.exists(dest_dir_file):
-                    count = incr_count(count)
-                    if filename_split[1] == '':
-                        dest_file = os.path.join(filename_split[0] + "_{}".format(count))
-                    else:
-                        dest_file = os.path.join(filename_split[0] + "_{}".format(count) + filename_split[1])
-                    dest_dir_file = os.path.join(dest_dir, dest_file)
-                log.info('Incrementing {} to {}'.format(sanitize_object(filename),
-                                                        sanitize_object(dest_file)))
-                shutil.copy(file, dest_dir_file)
-                yield dest_dir_file + '\n'
-            else:
-                dest_dir_file = os.path.join(filter_dir, filename)
-                shutil.copy(file, dest_dir_file)
-                yield dest_dir_file + '\n'
-
-    @staticmethod
-    def _ignore(filter_dir, filter_group):
-
-        for file in filter_group:
-            filename = os.path.split(file)[1]
-            dest_file = os.path.join(filter_dir, filename)
-            if os.path.exists(dest_file):
-                msg = "{} Exists, Ignoring {}".format(
-                    sanitize_object(dest_file),
-                    sanitize_object(file))
-                log.info(msg)
-                continue
-            else:
-                dest_dir_file = os.path.join(filter_dir, filename)
-                shutil.copy(file, dest_dir_file)
-                yield dest_dir_file + '\n'
-
-    @staticmethod
-    def _error(filter_dir, filter_group):
-        for file in filter_group:
-            filename = os.path.split(file)[1]
-            dest_dir_file = os.path.join(filter_dir, filename)
-            if os.path.exists(dest_dir_file):
-                log.error('{} already exists, exiting'.format(sanitize_object(dest_dir_file)))
-                exit(1)
-            else:
-                dest_dir_file = os.path.join(filter_dir, filename)
-                shutil.copy(file, dest_dir_file)
-                yield dest_dir_file + '\n'
-
-    @staticmethod
-    def _condition(filter_dir, filter_group, *, condition=None):
-        assert condition is not None
-
-        def modification_date(filename: str) -> str:
-            modification_time = os.path.getmtime(filename)
-            modified_datetime = datetime.datetime.fromtimestamp(modification_time)
-            return str(modified_datetime)
-
-        def disk_size(filename: str) -> str:
-            byte_usage = os.path.getsize(filename)
-            return str(byte_usage)
-
-        conditions = {
-            'LARGER' : lambda file1, file2: disk_size(file1) > disk_size(file2),
-            'SMALLER': lambda file1, file2: disk_size(file1) < disk_size(file2),
-            'NEWER'  : lambda file1, file2: modification_date(file1) < modification_date(file2),
-            'OLDER'  : lambda file1, file2: modification_date(file1) > modification_date(file2),
-        }
-        condition = conditions[condition.upper()]
-
-        for file in filter_group:
-            filename = os.path.split(file)[1]
-            dest_dir_file = os.path.join(filter_dir, filename)
-            if os.path.exists(dest_dir_file):
-                if condition(file, dest_dir_file):
-                    log.info("{} overwriting {}".format(sanitize_object(file),
-                                                        sanitize_object(dest_dir_file)))
-                    shutil.copy(file, dest_dir_file)
-                    yield dest_dir_file + '\n'
-            else:
-                dest_dir_file = os.path.join(filter_dir, filename)
-                shutil.copy(file, dest_dir_file)
-                yield dest_dir_file + '\n'
-
-
+    def _abstract_call(filtered_group, *, planner, labeled_filters):
+        filter_dir = os.path.join(planner.merge_dir, *labeled_filters.values())
+        destinations, transfers = planner.plan(filter_dir, filtered_group)
+        if ActionAppendMerge.dry_run is True:
+            return ['{source} -> {destination}{replace}\n'.format(source=source,
+                                                                  destination=destination,
+                                                                  replace=' (replace)' if replace else '')
+                    for source, destination, replace in transfers]
+        planner.execute(transfers, ActionAppendMerge.engine)
+        return [destination + '\n' for destination in destinations]
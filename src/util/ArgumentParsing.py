@@ -1,4 +1,3 @@
-import os
 from functools import partial
 
 from util.ActionCreateFilter import ActionSelectFilter
@@ -7,6 +6,15 @@ from util.ActionCreateFunc import ActionAppendExecShell, \
     remove_files, \
     hardlink_files, \
     print_results
+from util.CachePolicy import policies as cache_policies
+from util.CopyEngine import modes as merge_modes
+from util.DirectorySearch import ParallelWalker
+from util.Output import formats as output_formats
+from util.FilterCache import default_cache_path
+
+
+basic_print_results = partial(print_results, basic_formatting=True)
+basic_print_results.source_first = True
 
 
 def parser_logic(parser):
@@ -31,6 +39,23 @@ def parser_logic(parser):
                         help=help_exec_merge,
                         )
 
+    parser.add_argument('--merge-mode',
+                        choices=merge_modes,
+                        default='copy',
+                        help="how --exec-merge puts files in DIRECTORY\n"
+                             "copy     = reflink when supported, otherwise copy in the kernel\n"
+                             "reflink  = only reflink, on filesystems such as btrfs and XFS\n"
+                             "hardlink = hard link to each file\n"
+                             "move     = move each file\n"
+                             "default = copy",
+                        )
+
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help="print where --exec-merge would put each file, or the files --exec-remove\n"
+                             "or --exec-link would change, without changing anything",
+                        )
+
     parser.add_argument('--exec-remove',
                         const=remove_files,
                         dest="group_action",
@@ -43,13 +68,69 @@ def parser_logic(parser):
                         action='append_const',
                         )
 
+    parser.add_argument('--batch',
+                        action='store_true',
+                        help="with --exec-remove or --exec-link, ask once for every group\n"
+                             "then remove or link the files of --jobs groups at once",
+                        )
+
+    parser.add_argument('--write-plan',
+                        metavar='FILE',
+                        help="with --exec-remove or --exec-link, write the files each would remove\n"
+                             "or link to FILE, without changing any",
+                        )
+
+    parser.add_argument('--apply-plan',
+                        metavar='FILE',
+                        help="remove or link the files in a plan written by --write-plan, without asking\n"
+                             "files changed since it was written are skipped",
+                        )
+
+    parser.add_argument('--journal',
+                        metavar='FILE',
+                        help="with --batch or --apply-plan, record each file removed or linked in FILE\n"
+                             "files are kept until all are done, so the run can be resumed or rolled back",
+                        )
+
+    parser.add_argument('--resume',
+                        metavar='JOURNAL',
+                        help="finish the files left to remove or link by an interrupted run",
+                        )
+
+    parser.add_argument('--rollback',
+                        metavar='JOURNAL',
+                        help="restore the files removed or linked by an interrupted run",
+                        )
+
     parser.add_argument("--exec-basic-formatting",
-                        const=partial(print_results, basic_formatting=True),
+                        const=basic_print_results,
                         dest="group_action",
                         action="append_const",
                         help='no indenting or empty newlines in standard output',
                         )
 
+    parser.add_argument('--format',
+                        choices=output_formats,
+                        default='human',
+                        help="how results are written to standard output\n"
+                             "human = grouped and indented\n"
+                             "jsonl = a JSON object for each file, with its group, path, size,\n"
+                             "        inode, device and the output of each filter as f1..fn\n"
+                             "null  = each filename followed by NUL, each group followed by another NUL\n"
+                             "csv   = a row for each file, with the fields of jsonl\n"
+                             "default = human",
+                        )
+
+    parser.add_argument('-d', '--duplicates',
+                        action='store_true',
+                        help=help_duplicates,
+                        )
+
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help="compare the contents of grouped files byte for byte",
+                        )
+
     parser.add_argument('-r', '--recursive',
                         action='store_true',
                         )
@@ -64,6 +145,18 @@ def parser_logic(parser):
                         metavar='FILE',
                         )
 
+    parser.add_argument('--files-from',
+                        metavar='FILE',
+                        help="group the files listed in FILE, one per line, or - for standard input\n"
+                             "each is grouped as listed, without searching for it",
+                        )
+
+    parser.add_argument('-0', '--null',
+                        action='store_true',
+                        help="filenames listed are each followed by a NUL character,\n"
+                             "as output by find -print0",
+                        )
+
     parser.add_argument('--dir-include',
                         action='append',
                         metavar='DIRECTORY',
@@ -81,6 +174,7 @@ def parser_logic(parser):
     parser.add_argument("--max-depth",
                         type=int,
                         metavar='DEPTH',
+                        help="number of directories to descend when recursive",
                         )
 
     parser.add_argument('--empty-file',
@@ -99,14 +193,152 @@ def parser_logic(parser):
                         help="Minimum number of files in each group",
                         )
 
+    parser.add_argument('--filter-batch',
+                        metavar='N',
+                        type=int,
+                        default=100,
+                        help="number of files given to a shell filter using {+}\n"
+                             "default = 100",
+                        )
+
+    parser.add_argument('-j', '--jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="number of files filtered, or shell commands run, at once",
+                        )
+
+    parser.add_argument('--device-jobs',
+                        metavar='N',
+                        type=int,
+                        help="read files with a queue for each device, all devices at once\n"
+                             "N files are read at once from each solid state or network device,\n"
+                             "rotational disks read one file at a time in the order they are on disk",
+                        )
+
+    parser.add_argument('--compact',
+                        action='store_true',
+                        help="use less memory for each file found, for searches of millions of files",
+                        )
+
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help="print each group, and run its action, as soon as a file joins it\n"
+                             "for paths read from a file or pipe that may never end",
+                        )
+
+    parser.add_argument('--stream-max-singletons',
+                        metavar='N',
+                        type=int,
+                        default=100000,
+                        help="unmatched files remembered while streaming, the oldest are forgotten\n"
+                             "default = 100000",
+                        )
+
+    parser.add_argument('--stream-max-groups',
+                        metavar='N',
+                        type=int,
+                        default=100000,
+                        help="groups remembered while streaming, the least recently joined are forgotten\n"
+                             "default = 100000",
+                        )
+
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help="after searching, keep watching the directories (Linux)\n"
+                             "groups are shown, and acted on, as files are written, moved or deleted",
+                        )
+
+    parser.add_argument('--shell-pool',
+                        action='store_true',
+                        help="run shell filters and commands in shells kept running,\n"
+                             "instead of starting a shell each time",
+                        )
+
+    parser.add_argument('--walk-jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help="number of directories listed at once",
+                        )
+
+    parser.add_argument('--walk-order',
+                        choices=ParallelWalker.orders,
+                        default='listed',
+                        help="order files are found in\n"
+                             "listed    = order each directory lists them\n"
+                             "sorted    = by name within each directory\n"
+                             "unordered = as each directory is listed, with --walk-jobs\n"
+                             "default = listed",
+                        )
+
+    parser.add_argument('--read-size',
+                        metavar='BYTES',
+                        type=int,
+                        help="bytes read at once by checksum filters\n"
+                             "default = preferred block size of the file, at least 131072",
+                        )
+
+    parser.add_argument('--mmap-threshold',
+                        metavar='BYTES',
+                        type=int,
+                        help="memory map files of at least BYTES for checksum filters",
+                        )
+
+    parser.add_argument('--cache-policy',
+                        choices=cache_policies,
+                        default='keep',
+                        help="how files read by checksum filters use the page cache\n"
+                             "keep      = as any other program\n"
+                             "readahead = read the start of the next file while filtering\n"
+                             "drop      = readahead, dropping each part of a file once read\n"
+                             "direct    = bypass the page cache with O_DIRECT\n"
+                             "default = keep",
+                        )
+
+    parser.add_argument('--cache',
+                        metavar='PATH',
+                        nargs='?',
+                        const=default_cache_path(),
+                        help="keep filter output in a cache, so unchanged files aren't read again\n"
+                             "PATH default = {}".format(default_cache_path()),
+                        )
+
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help="don't use the filter output cache, the default",
+                        )
+
+    parser.add_argument('--snapshot',
+                        metavar='FILE',
+                        help="keep directory listings and filter output in FILE, only directories\n"
+                             "modified since the last run are listed again, used in place of the cache",
+                        )
+
+    parser.add_argument('--cache-max-age',
+                        metavar='DAYS',
+                        type=float,
+                        default=30,
+                        help="evict cached output unused for DAYS\n"
+                             "default = 30",
+                        )
+
+    parser.add_argument('--cache-max-size',
+                        metavar='MB',
+                        type=float,
+                        default=512,
+                        help="evict least recently used output above MB\n"
+                             "default = 512",
+                        )
+
     parser.add_argument('-v', '--verbosity',
                         default=3,
                         action="count",
                         )
 
+    # Defaults to the current directory, unless --files-from is given
     parser.add_argument('directories',
                         metavar="directory",
-                        default=[os.getcwd()],
                         nargs='*',
                         )
     return parser
@@ -115,8 +347,15 @@ def parser_logic(parser):
 help_filter = """builtin filters
 modifiers with syntax filter:modifier
   partial_md5
+  head    ::BYTES
+  tail    ::BYTES
+  sample  ::BLOCKS
   md5
   sha     ::[1, 224, 256, 384, 512, 3_224, 3_256, 3_384, 3_512]
+  blake2b ::DIGEST_SIZE
+  blake2s ::DIGEST_SIZE
+  crc
+  compare ::BYTES
   modified::[MICROSECOND, SECOND, MINUTE, HOUR, DAY, MONTH, YEAR, WEEKDAY] | '%%DIRECTIVE'
   accessed::[MICROSECOND, SECOND, MINUTE, HOUR, DAY, MONTH, YEAR, WEEKDAY] | '%%DIRECTIVE'
   size    ::[B, KB, MB, GB, TB, PB]
@@ -126,8 +365,19 @@ example: -f modified
 
 shell filters
 filenames represented as {}: 
+many filenames at once represented as {+}:
+  output one line or NUL terminated result per filename
 example: -f \"du {} | cut -f1\"
          -f \"exiftool -p '\$DateTimeOriginal' {} | cut -d\: -f1\"
+         -f \"exiftool -p '\$DateTimeOriginal' {+} | cut -d\: -f1\"
+"""
+
+help_duplicates = """find duplicate files in stages
+size, then md5 of the first 4096 bytes (head),
+the last 4096 bytes (tail), 16 blocks spread across
+the file (sample) and the whole file (md5)
+only files still matching another file are read further
+implies --group-size 2
 """
 
 help_exec_shell = """complete shell command on grouped files
@@ -138,6 +388,7 @@ notation:
   {//}: path of filename
   {/.}: filename, extension and path removed
   {..}: extension of filename
+  {+} : every filename in the group, run once
   {fn}: filter output of filter n
 example: -x "mkdir {f1}; mv {} {f1}/{/}"
          -x "mkdir {f1}; ffmpeg -i {} ogg/{/.}.ogg"
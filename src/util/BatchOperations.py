@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import threading
+
+from util.Parallel import ordered_map
+from util.Templates import sanitize_object
+
+log = logging.getLogger(__name__)
+
+# First line of a plan written by --write-plan, and of a journal
+_plan_header = 'groupby_plan'
+_journal_header = 'groupby_journal'
+_version = 1
+
+
+def _fingerprint(path) -> list:
+    stat = os.stat(path)
+    return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def _sibling(path, token, number, suffix) -> str:
+    # A name next to path, on the same filesystem so it can be renamed over path
+    return os.path.join(os.path.dirname(path), '.groupby-{token}-{number}{suffix}'.format(
+        token=token, number=number, suffix=suffix))
+
+
+def _same_file(source, path) -> bool:
+    try:
+        return os.path.samefile(source, path)
+    except OSError:
+        return False
+
+
+def _remove_stale(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_operation(source, path) -> dict:
+    return {'op': 'remove', 'source': source, 'path': path,
+            'source_stat': _fingerprint(source), 'path_stat': _fingerprint(path)}
+
+
+def link_operation(source, path) -> dict:
+    return {'op': 'link', 'source': source, 'path': path,
+            'source_stat': _fingerprint(source), 'path_stat': _fingerprint(path)}
+
+
+def describe(operation) -> str:
+    if operation['op'] == 'link':
+        return "Linking {source} -> {path}".format(source=sanitize_object(operation['source']),
+                                                  path=sanitize_object(operation['path']))
+    return "Removing {path}".format(path=sanitize_object(operation['path']))
+
+
+class Journal:
+    '''
+        Every operation of a run, written before any is made, followed by each operation made.
+        Files replaced or removed are kept under a hidden name beside them until every operation is made,
+        so an interrupted run can be resumed, or rolled back to leave each file as it was
+    '''
+
+    def __init__(self, path, *, token, groups, done=(), state=None):
+        self.path = path
+        self.token = token
+        self.groups = groups
+        self.done = set(done)
+        # None while operations are being made, then 'committed' or 'rolled_back'
+        self.state = state
+        self._file = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, groups):
+        if os.path.lexists(path):
+            log.error("Journal {} already exists".format(sanitize_object(path)))
+            exit(1)
+        journal = cls(path, token=os.urandom(4).hex(), groups=groups)
+        journal._file = open(path, 'w')
+        journal._write({_journal_header: _version, 'token': journal.token})
+        for group_number, group in enumerate(groups):
+            for operation in group:
+                journal._write(dict(operation, group=group_number))
+        journal._sync()
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        header, lines = _read_lines(path, _journal_header)
+        groups = list()
+        done = set()
+        state = None
+        for line in lines:
+            if 'op' in line:
+                while len(groups) <= line['group']:
+                    groups.append(list())
+                groups[line['group']].append(line)
+            elif 'done' in line:
+                done.add(line['done'])
+            elif 'state' in line:
+                state = line['state']
+        journal = cls(path, token=header['token'], groups=groups, done=done, state=state)
+        journal._file = open(path, 'a')
+        return journal
+
+    def backup(self, operation) -> str:
+        return _sibling(operation['path'], self.token, operation['id'], '.orig')
+
+    def _write(self, line):
+        self._file.write(json.dumps(line) + '\n')
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def mark_done(self, operation):
+        with self._lock:
+            self.done.add(operation['id'])
+            self._write({'done': operation['id']})
+            # Flushed, not synced, an operation made again after a crash finds it was made
+            self._file.flush()
+
+    def commit(self):
+        # Every operation is made, the files kept to roll back are removed
+        for group in self.groups:
+            for operation in group:
+                _remove_stale(self.backup(operation))
+        self._end('committed')
+
+    def rollback(self) -> bool:
+        restored = True
+        for group in reversed(self.groups):
+            for operation in reversed(group):
+                _remove_stale(_sibling(operation['path'], self.token, operation['id'], '.tmp'))
+                backup = self.backup(operation)
+                if not os.path.lexists(backup):
+                    continue
+                if operation['op'] == 'remove' and os.path.lexists(operation['path']):
+                    log.warning("{path} was created again, {backup} is left as it was".format(
+                        path=sanitize_object(operation['path']),
+                        backup=sanitize_object(backup)))
+                    restored = False
+                    continue
+                os.replace(backup, operation['path'])
+                log.info("Restored {}".format(sanitize_object(operation['path'])))
+        self._end('rolled_back')
+        return restored
+
+    def _end(self, state):
+        self.state = state
+        self._write({'state': state})
+        self._sync()
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _read_lines(path, header_key) -> tuple:
+    try:
+        with open(path) as file:
+            lines = [json.loads(line) for line in file if line.strip()]
+    except (OSError, ValueError) as e:
+        log.error("Unable to read {path}: {err}".format(path=sanitize_object(path), err=e))
+        exit(1)
+    if not lines or lines[0].get(header_key) != _version:
+        log.error("{} is not a groupby {}".format(sanitize_object(path), header_key.split('_')[1]))
+        exit(1)
+    return lines[0], lines[1:]
+
+
+def write_plan(path, groups):
+    with open(path, 'w') as file:
+        file.write(json.dumps({_plan_header: _version}) + '\n')
+        for group_number, group in enumerate(groups):
+            for operation in group:
+                file.write(json.dumps(dict(operation, group=group_number)) + '\n')
+
+
+def read_plan(path) -> list:
+    header, lines = _read_lines(path, _plan_header)
+    groups = list()
+    for line in lines:
+        while len(groups) <= line['group']:
+            groups.append(list())
+        groups[line['group']].append(line)
+    return groups
+
+
+def apply(operation, *, token, journal=None) -> bool:
+    # Makes the operation, True once it is made, or if it was already made by an interrupted run
+    source, path = operation['source'], operation['path']
+    backup = journal.backup(operation) if journal is not None else None
+    if operation['op'] == 'link':
+        if _same_file(source, path):
+            return True
+    elif backup is not None and os.path.lexists(backup):
+        return True
+
+    # Neither file may have changed since the operation was planned
+    for filename, fingerprint in ((source, operation['source_stat']), (path, operation['path_stat'])):
+        try:
+            unchanged = _fingerprint(filename) == fingerprint
+        except FileNotFoundError:
+            log.warning("{} Not Found".format(sanitize_object(filename)))
+            return False
+        if unchanged is False:
+            log.warning("{} changed since it was planned, skipping {}".format(
+                sanitize_object(filename),
+                sanitize_object(path)))
+            return False
+
+    log.info(describe(operation))
+    if operation['op'] == 'link':
+        # The new link takes the place of path at once, path is never missing
+        temporary = _sibling(path, token, operation['id'], '.tmp')
+        _remove_stale(temporary)
+        if backup is not None and not os.path.lexists(backup):
+            os.link(path, backup)
+        os.link(source, temporary)
+        os.replace(temporary, path)
+    elif backup is not None:
+        os.rename(path, backup)
+    else:
+        os.remove(path)
+    return True
+
+
+def run(groups, *, jobs=1, journal=None) -> bool:
+    # Makes the operations of up to jobs groups at once, each group's in order
+    # Returns False if any operation failed
+    token = journal.token if journal is not None else os.urandom(4).hex()
+    counts = {'made': 0, 'skipped': 0, 'failed': 0}
+
+    def run_group(group):
+        results = list()
+        for operation in group:
+            if journal is not None and operation['id'] in journal.done:
+                results.append('made')
+                continue
+            try:
+                made = apply(operation, token=token, journal=journal)
+            except OSError as e:
+                log.error("{operation} failed: {err}".format(operation=describe(operation), err=e.strerror))
+                results.append('failed')
+                continue
+            if made is True and journal is not None:
+                journal.mark_done(operation)
+            results.append('made' if made is True else 'skipped')
+        return results
+
+    for results in ordered_map(run_group, groups, jobs=jobs):
+        for result in results:
+            counts[result] += 1
+    log.info("{made} files removed or linked, {skipped} skipped, {failed} failed".format(**counts))
+
+    if journal is not None:
+        # Files skipped have changed, running again skips them again
+        if counts['failed'] == 0:
+            journal.commit()
+        else:
+            log.warning("Resume with --resume {path} or undo with --rollback {path}".format(
+                path=sanitize_object(journal.path)))
+            journal.close()
+    return counts['failed'] == 0
+
+
+def number_operations(groups):
+    # Each operation is given an id, unique within the run
+    number = 0
+    for group in groups:
+        for operation in group:
+            operation['id'] = number
+            number += 1
+    return groups
+
+
+class BatchOperations:
+    '''
+        The operations of --exec-remove and --exec-link, gathered from every group
+        with --batch or --write-plan rather than asking for each group
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.groups = list()
+
+    def add(self, operations):
+        if operations:
+            self.groups.append(operations)
+
+    def count(self, op) -> int:
+        return sum(1 for group in self.groups for operation in group if operation['op'] == op)
+
+
+batch = BatchOperations()
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,264 @@
+import errno
+import logging
+import mmap
+import os
+
+try:
+    import ctypes
+    _mincore = ctypes.CDLL(None, use_errno=True).mincore
+    _mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p)
+except (ImportError, OSError, AttributeError, TypeError):
+    _mincore = None
+
+log = logging.getLogger(__name__)
+
+# keep:      read as any other program would
+# readahead: read sequentially, starting to read the next file while the current file is filtered
+# drop:      as readahead, dropping each part of a file from the page cache once it is read
+# direct:    read with O_DIRECT, without using the page cache
+policies = ('keep', 'readahead', 'drop', 'direct')
+
+# O_DIRECT reads must start and end on a multiple of the logical block size of the device,
+# into a buffer aligned to it. A page is a multiple of every usual block size
+_alignment = mmap.PAGESIZE
+# Bytes read between each time the pages read are dropped
+_drop_interval = 8388608
+# Bytes read from the start of the next file ahead of it being filtered
+_read_ahead_size = 131072
+# mincore sets the lowest bit of the byte of each page in the page cache, the other bits are undefined
+_resident_bit = bytes(value & 1 for value in range(256))
+
+_warned = set()
+
+
+def _warn_once(message):
+    if message not in _warned:
+        _warned.add(message)
+        log.warning(message)
+
+
+def supported(policy) -> bool:
+    if policy == 'keep':
+        return True
+    if not hasattr(os, 'posix_fadvise'):
+        _warn_once("--cache-policy {} is not supported on this system".format(policy))
+        return False
+    if policy == 'direct' and getattr(os, 'O_DIRECT', None) is None:
+        _warn_once("--cache-policy direct is not supported on this system")
+        return False
+    return True
+
+
+def read_ahead(path, policy):
+    # Asks the kernel to start reading the start of path, which is read next
+    if policy not in ('readahead', 'drop'):
+        return None
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        os.posix_fadvise(fd, 0, _read_ahead_size, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def resident_pages(fd, size):
+    # A byte for each page of the file, 1 if it is in the page cache, or None if it can't be told
+    if _mincore is None or size == 0:
+        return None
+    try:
+        # A private mapping is writable, as ctypes needs to take its address, without the file being
+        mapped = mmap.mmap(fd, size, access=mmap.ACCESS_COPY)
+    except (OSError, ValueError):
+        return None
+    vector = ctypes.create_string_buffer(-(-size // mmap.PAGESIZE))
+    try:
+        address = ctypes.c_char.from_buffer(mapped)
+        try:
+            result = _mincore(ctypes.addressof(address), size, vector)
+        finally:
+            del address
+    finally:
+        mapped.close()
+    if result != 0:
+        return None
+    return vector.raw.translate(_resident_bit)
+
+
+def _absent_runs(resident, first, last):
+    # (start, stop) of each run of pages from first to last that weren't resident,
+    # pages past the end of resident weren't
+    end = min(last, len(resident))
+    page = first
+    while page < end:
+        start = resident.find(0, page, end)
+        if start == -1:
+            break
+        stop = resident.find(1, start, end)
+        if stop == -1:
+            stop = end
+        yield start, stop
+        page = stop
+    if last > max(first, len(resident)):
+        yield max(first, len(resident)), last
+
+
+def open_file(path, policy='keep'):
+    # An unbuffered binary file following policy, with the seek, read and readinto of open(path, 'rb', buffering=0)
+    if policy == 'keep' or not supported(policy):
+        return open(path, 'rb', buffering=0)
+    if policy == 'direct':
+        try:
+            return DirectFile(path)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            # The filesystem doesn't support O_DIRECT, such as tmpfs
+            _warn_once("O_DIRECT is not supported for {}, dropping pages read instead".format(path))
+            policy = 'drop'
+    return AdvisedFile(path, drop=policy == 'drop')
+
+
+class AdvisedFile:
+    '''
+        A file read sequentially, hinted to the kernel with posix_fadvise.
+        With drop, the pages read are dropped from the page cache once read,
+        so reading many files doesn't push out the files used by other programs.
+        Pages already in the page cache when the file was opened, found with mincore, are never dropped.
+        Where mincore can't be used, no pages are dropped
+    '''
+
+    def __init__(self, path, *, drop=False):
+        self.name = path
+        self.drop = drop
+        self._dropped = 0
+        self._file = open(path, 'rb', buffering=0)
+        try:
+            os.posix_fadvise(self._file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+        self._resident = None
+        if drop:
+            size = os.fstat(self._file.fileno()).st_size
+            self._resident = resident_pages(self._file.fileno(), size)
+            if self._resident is None:
+                if _mincore is None:
+                    _warn_once("--cache-policy drop can't find the pages already cached on this system, "
+                               "none are dropped")
+                # Empty, or its pages can't be told apart, so none are dropped
+                self.drop = False
+            elif 0 not in self._resident:
+                # Every page was already cached
+                self.drop = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def readinto(self, buffer) -> int:
+        read_size = self._file.readinto(buffer)
+        # Pages are dropped a while after being read, pages still being read ahead aren't dropped
+        if self.drop and read_size and self._file.tell() - self._dropped >= _drop_interval:
+            self._drop(self._dropped, self._file.tell())
+            self._dropped = self._file.tell()
+        return read_size
+
+    def _drop(self, start, end):
+        # Drops from the page cache the pages from start to end that weren't cached when the file was opened
+        for first, last in _absent_runs(self._resident, start // mmap.PAGESIZE, -(-end // mmap.PAGESIZE)):
+            try:
+                os.posix_fadvise(self._file.fileno(), first * mmap.PAGESIZE, (last - first) * mmap.PAGESIZE,
+                                 os.POSIX_FADV_DONTNEED)
+            except OSError:
+                return None
+
+    def read(self, size) -> bytes:
+        buffer = bytearray(size)
+        read_size = self.readinto(buffer)
+        return bytes(buffer[:read_size])
+
+    def close(self):
+        if self.drop and not self._file.closed:
+            # Pages read ahead past those read are dropped too
+            self._drop(0, os.fstat(self._file.fileno()).st_size)
+        self._file.close()
+
+
+class DirectFile:
+    '''
+        A file read with O_DIRECT, bypassing the page cache.
+        Reads are made aligned into a page aligned buffer, then copied to the buffer given,
+        so any offset and size may be read
+    '''
+
+    def __init__(self, path):
+        self.name = path
+        self._fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        self._position = 0
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fileno(self):
+        return self._fd
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self._position = offset
+        elif whence == os.SEEK_CUR:
+            self._position += offset
+        else:
+            self._position = os.fstat(self._fd).st_size + offset
+        return self._position
+
+    def _aligned_buffer(self, size) -> mmap.mmap:
+        # Anonymous memory maps are page aligned, and reused for every read of the file
+        if self._buffer is None or len(self._buffer) < size:
+            if self._buffer is not None:
+                self._buffer.close()
+            self._buffer = mmap.mmap(-1, size)
+        return self._buffer
+
+    def readinto(self, buffer) -> int:
+        buffer = memoryview(buffer)
+        skip = self._position % _alignment
+        size = -(-(skip + len(buffer)) // _alignment) * _alignment
+        os.lseek(self._fd, self._position - skip, os.SEEK_SET)
+        with memoryview(self._aligned_buffer(size)) as aligned:
+            with aligned[:size] as view:
+                read_size = max(min(os.readv(self._fd, [view]) - skip, len(buffer)), 0)
+                buffer[:read_size] = view[skip:skip + read_size]
+        self._position += read_size
+        return read_size
+
+    def read(self, size) -> bytes:
+        buffer = bytearray(size)
+        read_size = self.readinto(buffer)
+        return bytes(buffer[:read_size])
+
+    def close(self):
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+if __name__ == '__main__':
+    pass
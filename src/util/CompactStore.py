@@ -0,0 +1,183 @@
+import os
+import re
+import struct
+from array import array
+
+# Filter output is stored as raw bytes, tagged with the type it is returned as
+_BYTES = 0
+_TEXT = 1
+_HEX = 2
+
+_hex = re.compile('^(?:[0-9a-f]{2})+$')
+
+# Marks a file with no output stored in a column
+_unset = 0xFFFFFFFF
+
+# The stat of a file as the filters use it, st_dev, st_ino, st_size, st_atime_ns, st_mtime_ns, st_ctime_ns,
+# st_mode, st_nlink and st_blksize. A file whose stat isn't known is stored as zeros
+_stat = struct.Struct('QQQqqqIII')
+_no_stat = bytes(_stat.size)
+
+
+def encode_output(output) -> bytes:
+    # Hexadecimal digests are kept as the bytes they represent, half the length of the text
+    if isinstance(output, bytes):
+        return bytes((_BYTES,)) + output
+    if _hex.match(output):
+        return bytes((_HEX,)) + bytes.fromhex(output)
+    return bytes((_TEXT,)) + output.encode('utf-8', errors='surrogateescape')
+
+
+def decode_output(encoded):
+    kind, data = encoded[0], bytes(encoded[1:])
+    if kind == _HEX:
+        return data.hex()
+    if kind == _TEXT:
+        return data.decode('utf-8', errors='surrogateescape')
+    return data
+
+
+def _seconds(nanoseconds) -> float:
+    # As os.stat gives the time in seconds from the time in nanoseconds
+    seconds, nanoseconds = divmod(nanoseconds, 1000000000)
+    return seconds + nanoseconds * 1e-9
+
+
+def _grow(column, length, fill=0):
+    if len(column) < length:
+        column.extend(array(column.typecode, (fill,)) * (length - len(column)))
+
+
+class OutputColumn:
+    '''
+        The output of one filter for every file, encoded and appended to a single bytearray.
+        The position and length of each file's output is kept in arrays indexed by file id
+    '''
+    __slots__ = ('data', 'starts', 'lengths')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.starts = array('Q')
+        self.lengths = array('I')
+
+    def __contains__(self, file_id):
+        return file_id < len(self.lengths) and self.lengths[file_id] != _unset
+
+    def __getitem__(self, file_id):
+        start = self.starts[file_id]
+        return self.data[start:start + self.lengths[file_id]]
+
+    def __setitem__(self, file_id, encoded):
+        # Files are mostly given output in order of their id
+        if file_id == len(self.starts):
+            self.starts.append(len(self.data))
+            self.lengths.append(len(encoded))
+        else:
+            _grow(self.starts, file_id + 1)
+            _grow(self.lengths, file_id + 1, fill=_unset)
+            self.starts[file_id] = len(self.data)
+            self.lengths[file_id] = len(encoded)
+        self.data += encoded
+
+
+class CompactStore:
+    '''
+        Paths and filter output of many files, without a string and list for each file.
+        A path is a directory id and basename, the directories kept once in a table
+        ending with a separator. The stat of each file is packed into a fixed size record,
+        so it is not read again by each filter.
+        Files are identified by their position, a file id
+    '''
+    __slots__ = ('directories', '_directory_ids', '_file_directories', '_names', '_name_ends', '_stats', 'columns')
+
+    def __init__(self):
+        self.directories = list()
+        self._directory_ids = dict()
+        self._file_directories = array('I')
+        self._names = bytearray()
+        self._name_ends = array('Q')
+        self._stats = bytearray()
+        self.columns = list()
+
+    def __len__(self):
+        return len(self._file_directories)
+
+    def add(self, path, stat=None) -> int:
+        directory, name = os.path.split(path)
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = self._directory_ids[directory] = len(self.directories)
+            self.directories.append(os.path.join(directory, ''))
+
+        self._file_directories.append(directory_id)
+        self._names += os.fsencode(name)
+        self._name_ends.append(len(self._names))
+        if stat is None:
+            self._stats += _no_stat
+        else:
+            self._stats += _stat.pack(stat.st_dev, stat.st_ino, stat.st_size,
+                                      stat.st_atime_ns, stat.st_mtime_ns, stat.st_ctime_ns,
+                                      stat.st_mode, stat.st_nlink, stat.st_blksize)
+        return len(self._file_directories) - 1
+
+    def path(self, file_id) -> str:
+        name_start = self._name_ends[file_id - 1] if file_id > 0 else 0
+        name = os.fsdecode(bytes(self._names[name_start:self._name_ends[file_id]]))
+        return self.directories[self._file_directories[file_id]] + name
+
+    def stat(self, file_id):
+        # An os.stat_result of the fields stored, without st_uid and st_gid, or None if not known
+        dev, ino, size, atime_ns, mtime_ns, ctime_ns, mode, nlink, blksize = _stat.unpack_from(
+            self._stats, file_id * _stat.size)
+        if nlink == 0:
+            return None
+        return os.stat_result((mode, ino, dev, nlink, 0, 0, size,
+                               atime_ns // 1000000000, mtime_ns // 1000000000, ctime_ns // 1000000000,
+                               _seconds(atime_ns), _seconds(mtime_ns), _seconds(ctime_ns),
+                               atime_ns, mtime_ns, ctime_ns, blksize))
+
+    def append_output(self, file_id, output) -> bytes:
+        # Stored in the first column without output for the file, the filters are run in order
+        encoded = encode_output(output)
+        for column in self.columns:
+            if file_id not in column:
+                column[file_id] = encoded
+                return encoded
+        column = OutputColumn()
+        column[file_id] = encoded
+        self.columns.append(column)
+        return encoded
+
+    def outputs(self, file_id) -> list:
+        return [decode_output(column[file_id]) for column in self.columns if file_id in column]
+
+
+class GroupTable:
+    '''
+        Files grouped by encoded filter output, in the order each output is first seen.
+        A file alone in its group is kept as its id, larger groups as an array of ids
+    '''
+    __slots__ = ('_groups',)
+
+    def __init__(self):
+        self._groups = dict()
+
+    def append(self, key, file_id):
+        group = self._groups.get(key)
+        if group is None:
+            self._groups[key] = file_id
+        elif isinstance(group, int):
+            self._groups[key] = array('I', (group, file_id))
+        else:
+            group.append(file_id)
+
+    def values(self):
+        for group in self._groups.values():
+            if isinstance(group, int):
+                yield [group]
+            else:
+                yield list(group)
+
+
+if __name__ == '__main__':
+    pass
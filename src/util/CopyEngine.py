@@ -0,0 +1,237 @@
+import errno
+import logging
+import os
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from util.Templates import sanitize_object
+
+log = logging.getLogger(__name__)
+
+# copy:     a copy sharing the source's blocks when the filesystem allows it, otherwise copied in the kernel
+# reflink:  only a copy sharing the source's blocks, on copy on write filesystems such as btrfs and XFS
+# hardlink: a hard link to the source
+# move:     the source is renamed, or copied and removed across filesystems
+modes = ('copy', 'reflink', 'hardlink', 'move')
+
+# From <linux/fs.h>
+_FICLONE = 0x40049409
+# A method of copying unsupported for the files given, the next is tried
+_unsupported = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+                errno.ETXTBSY, errno.EPERM}
+_chunk_size = 1 << 30
+_userspace_size = 1048576
+
+
+def _reflink(source_fd, destination_fd, size):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks are not supported")
+    fcntl.ioctl(destination_fd, _FICLONE, source_fd)
+
+
+def _copy_file_range(source_fd, destination_fd, size):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range is not supported")
+    copied = 0
+    while True:
+        copied_size = os.copy_file_range(source_fd, destination_fd, _chunk_size)
+        if copied_size == 0:
+            break
+        copied += copied_size
+    # Some filesystems copy nothing rather than fail, the next method is tried
+    if copied == 0 and size > 0:
+        raise OSError(errno.ENOSYS, "copy_file_range copied nothing")
+
+
+def _sendfile(source_fd, destination_fd, size):
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, "sendfile is not supported")
+    offset = 0
+    while True:
+        sent_size = os.sendfile(destination_fd, source_fd, offset, _chunk_size)
+        if sent_size == 0:
+            break
+        offset += sent_size
+
+
+def _userspace(source_fd, destination_fd, size):
+    while True:
+        data = os.read(source_fd, _userspace_size)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(destination_fd, view):]
+
+
+# Tried in order until one is supported
+_copy_methods = (('reflink', _reflink),
+                 ('copy_file_range', _copy_file_range),
+                 ('sendfile', _sendfile),
+                 ('userspace', _userspace),
+                 )
+
+
+def copy_data(source, destination, *, methods=_copy_methods) -> str:
+    # Copies the contents of source over destination, returning the name of the method used
+    with open(source, 'rb', buffering=0) as source_file, open(destination, 'wb', buffering=0) as destination_file:
+        source_fd, destination_fd = source_file.fileno(), destination_file.fileno()
+        size = os.fstat(source_fd).st_size
+        error = None
+        for name, method in methods:
+            try:
+                method(source_fd, destination_fd, size)
+                return name
+            except OSError as e:
+                if e.errno not in _unsupported:
+                    raise
+                error = e
+                # Anything partly copied is copied again by the next method
+                os.ftruncate(destination_fd, 0)
+                os.lseek(destination_fd, 0, os.SEEK_SET)
+                os.lseek(source_fd, 0, os.SEEK_SET)
+        raise error
+
+
+class CopyEngine:
+    '''
+        Puts files in the merge directory by mode, one of modes.
+        Copies are made by up to jobs threads once the destination is created,
+        so the destination exists as soon as transfer returns.
+        close waits for every copy, returning False if any failed
+    '''
+
+    def __init__(self, *, mode='copy', jobs=1):
+        self.mode = mode
+        self.jobs = max(jobs, 1)
+        self.methods = Counter()
+        self.failed = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        # At most this many copies wait for a thread
+        self._slots = threading.BoundedSemaphore(self.jobs * 4)
+        # Destination -> its copy still being made
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def transfer(self, source, destination, *, replace=False):
+        if self.mode == 'hardlink':
+            self._link(source, destination, replace=replace)
+        elif self.mode == 'move':
+            try:
+                if replace is True:
+                    os.replace(source, destination)
+                else:
+                    os.rename(source, destination)
+                self.methods['rename'] += 1
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Across filesystems, copied then removed
+                self._copy(source, destination, remove=True)
+        else:
+            self._copy(source, destination)
+
+    def _link(self, source, destination, *, replace=False):
+        # A failed link is counted as a failed copy, copies already made or queued are still finished
+        temporary = None
+        try:
+            if replace is True:
+                temporary = '{}.{}.tmp'.format(destination, os.getpid())
+                os.link(source, temporary)
+                os.replace(temporary, destination)
+            else:
+                os.link(source, destination)
+        except OSError as e:
+            with self._lock:
+                self.failed += 1
+            if temporary is not None:
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+            log.error("Unable to hard link {source} to {destination}: {err}".format(
+                source=sanitize_object(source),
+                destination=sanitize_object(destination),
+                err=e.strerror))
+            return None
+        self.methods['hardlink'] += 1
+
+    def _copy(self, source, destination, *, remove=False):
+        self.wait(destination)
+        # Created before returning, so the name is seen as taken
+        with open(destination, 'wb'):
+            pass
+        if self._executor is None:
+            self._copy_now(source, destination, remove=remove)
+            return None
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._copy_now, source, destination, remove=remove)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending[destination] = future
+        future.add_done_callback(lambda future: self._done(destination, future))
+
+    def _done(self, destination, future):
+        with self._lock:
+            if self._pending.get(destination) is future:
+                del self._pending[destination]
+        self._slots.release()
+
+    def _copy_now(self, source, destination, *, remove=False):
+        methods = _copy_methods[:1] if self.mode == 'reflink' else _copy_methods
+        try:
+            method = copy_data(source, destination, methods=methods)
+            shutil.copymode(source, destination)
+            if remove is True:
+                os.remove(source)
+        except OSError as e:
+            with self._lock:
+                self.failed += 1
+            # Nothing is left partly copied
+            try:
+                os.remove(destination)
+            except OSError:
+                pass
+            if self.mode == 'reflink' and e.errno in _unsupported:
+                log.error("Unable to reflink {source} to {destination}, "
+                          "the filesystem doesn't support it: {err}".format(source=sanitize_object(source),
+                                                                           destination=sanitize_object(destination),
+                                                                           err=e.strerror))
+            else:
+                log.error("Unable to copy {source} to {destination}: {err}".format(
+                    source=sanitize_object(source),
+                    destination=sanitize_object(destination),
+                    err=e.strerror))
+            return None
+        with self._lock:
+            self.methods[method] += 1
+
+    def wait(self, destination):
+        # Waits for a copy to destination to be complete, before it is compared or replaced
+        with self._lock:
+            future = self._pending.get(destination)
+        if future is not None:
+            future.result()
+
+    def close(self) -> bool:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self.methods:
+            log.info("Merged {count} files: {methods}".format(
+                count=sum(self.methods.values()),
+                methods=', '.join('{} {}'.format(count, method) for method, count in self.methods.most_common())))
+        return self.failed == 0
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,241 @@
+import bisect
+import itertools
+import logging
+import os
+import struct
+import threading
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# From <linux/fiemap.h>, asking for the first extent of a file
+_FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap: u64 fm_start, fm_length, u32 fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+_fiemap = struct.Struct('QQIIII')
+# struct fiemap_extent: u64 fe_logical, fe_physical, fe_length, fe_reserved64[2], u32 fe_flags, fe_reserved[3]
+_fiemap_extent = struct.Struct('QQQQQIIII')
+_fiemap_request = _fiemap.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(_fiemap_extent.size)
+# Files of at least this many bytes on a rotational disk are read in the order of their position on it
+_physical_order_size = 1048576
+
+
+def is_rotational(device) -> bool:
+    # From /sys/dev/block on Linux, the queue of a partition is that of its disk
+    # Devices that aren't a block device, such as network and in memory filesystems, are not
+    block = '/sys/dev/block/{major}:{minor}'.format(major=os.major(device), minor=os.minor(device))
+    for queue in (os.path.join(block, 'queue'), os.path.join(block, '..', 'queue')):
+        try:
+            with open(os.path.join(queue, 'rotational')) as rotational:
+                return rotational.read().strip() == '1'
+        except OSError:
+            continue
+    return False
+
+
+def physical_offset(path):
+    # The position on the device of the start of the file, None if unknown
+    if fcntl is None:
+        return None
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        request = bytearray(_fiemap_request)
+        fcntl.ioctl(fd, _FS_IOC_FIEMAP, request)
+        if _fiemap.unpack_from(request)[3] == 0:
+            return None
+        return _fiemap_extent.unpack_from(request, _fiemap.size)[1]
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+class Chunk:
+    '''
+        Results of a run of items given to the scheduler, in the order given.
+        Each result is (True, value), or (False, exception) raised by the call.
+        SystemExit raised by a call is kept too, and raised again by values in the thread waiting on it
+    '''
+    __slots__ = ('results', '_remaining', '_lock', '_done')
+
+    def __init__(self, size):
+        self.results = [None] * size
+        self._remaining = size
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if size == 0:
+            self._done.set()
+
+    def set(self, index, result):
+        self.results[index] = result
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._done.set()
+
+    def values(self) -> list:
+        self._done.wait()
+        for succeeded, value in self.results:
+            if succeeded is False:
+                raise value
+        return [value for succeeded, value in self.results]
+
+
+def _call(func, item):
+    # BaseException, as a filter calling exit would otherwise end the worker with the chunk never done
+    try:
+        return True, func(item)
+    except BaseException as e:
+        return False, e
+
+
+class DeviceQueue:
+    '''
+        Calls waiting to read files of one device, run by its own threads.
+        On a rotational disk files are read one at a time, sweeping across the disk
+        in the order of their inode number, then large files in the order of their position on it.
+        Other devices read up to jobs files at once, in the order given.
+        Calls are added and taken a run at a time, so a thread isn't woken for every file
+    '''
+
+    def __init__(self, device, *, jobs, rotational, take=16):
+        self.device = device
+        self.rotational = rotational
+        self.jobs = 1 if rotational else jobs
+        self.take = take
+        # (position, number, func, item, chunk, index), sorted by position
+        self._waiting = list()
+        self._position = (0, 0)
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = list()
+
+    def position(self, path, stat, number):
+        if self.rotational:
+            # Finding where a file is means opening it, only worth it for files that take a while to read
+            # Smaller files are read first in the order of their inode, usually near their contents
+            offset = physical_offset(path) if stat.st_size >= _physical_order_size else None
+            return (1, offset) if offset is not None else (0, stat.st_ino)
+        return 0, number
+
+    def add(self, calls):
+        with self._condition:
+            # Numbers are unique, calls are only ever compared by position and number
+            for call in calls:
+                bisect.insort(self._waiting, call)
+            while len(self._threads) < self.jobs:
+                thread = threading.Thread(target=self._worker, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._condition.notify_all()
+
+    def _next(self) -> list:
+        # The next calls at or after the last position read, starting again from the first once passed
+        index = bisect.bisect_left(self._waiting, (self._position,))
+        if index == len(self._waiting):
+            index = 0
+        calls = self._waiting[index:index + self.take]
+        del self._waiting[index:index + self.take]
+        self._position = calls[-1][0]
+        return calls
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._waiting and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return None
+                calls = self._next()
+            for position, number, func, item, chunk, index in calls:
+                chunk.set(index, _call(func, item))
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._waiting.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+class DeviceScheduler:
+    '''
+        Reads files with a queue for each device they are on, so every device is read at once
+        without any one of them reading too many files at once.
+        jobs is the number of files read at once from each device that isn't rotational.
+        Items are given to the queues chunk_size at a time, up to window of them waiting
+        across every device. Results are returned in the order given
+    '''
+
+    def __init__(self, *, jobs=1, window=4096, chunk_size=256):
+        self.jobs = max(jobs, 1)
+        self.window = window
+        self.chunk_size = chunk_size
+        self._devices = dict()
+        self._numbers = itertools.count()
+        self._lock = threading.Lock()
+
+    def _queue(self, device) -> DeviceQueue:
+        with self._lock:
+            queue = self._devices.get(device)
+            if queue is None:
+                rotational = is_rotational(device)
+                queue = self._devices[device] = DeviceQueue(device, jobs=self.jobs, rotational=rotational)
+                log.debug("Reading device {major}:{minor}{rotational}, {jobs} files at once".format(
+                    major=os.major(device),
+                    minor=os.minor(device),
+                    rotational=' (rotational)' if rotational else '',
+                    jobs=queue.jobs))
+        return queue
+
+    def _submit(self, func, items, path, stat) -> Chunk:
+        chunk = Chunk(len(items))
+        # Device -> its queue, with the calls added to it
+        device_calls = dict()
+        for index, item in enumerate(items):
+            item_path = path(item)
+            try:
+                item_stat = stat(item_path)
+            except OSError:
+                # Called at once, the error is raised or handled by func
+                chunk.set(index, _call(func, item))
+                continue
+            queue, calls = device_calls.get(item_stat.st_dev, (None, None))
+            if queue is None:
+                queue, calls = device_calls[item_stat.st_dev] = self._queue(item_stat.st_dev), list()
+            number = next(self._numbers)
+            calls.append((queue.position(item_path, item_stat, number), number, func, item, chunk, index))
+        for queue, calls in device_calls.values():
+            queue.add(calls)
+        return chunk
+
+    def map(self, func, items, *, path, stat):
+        # Like ordered_map, func is called with each item on the queue of the device of path(item)
+        # stat(path) is used to find the device, an item it fails for is called at once
+        pending = deque()
+        items = iter(items)
+        while True:
+            chunk_items = list(itertools.islice(items, self.chunk_size))
+            if chunk_items:
+                pending.append(self._submit(func, chunk_items, path, stat))
+            if pending and (not chunk_items or len(pending) * self.chunk_size >= self.window):
+                for value in pending.popleft().values():
+                    yield value
+            elif not chunk_items:
+                break
+
+    def close(self):
+        for queue in self._devices.values():
+            queue.close()
+
+
+if __name__ == '__main__':
+    pass
@@ -1,33 +1,95 @@
 import logging
 import os
 import pathlib
+import stat
+import sys
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from util.Templates import negation
 
 log = logging.getLogger(__name__)
 
 
+class FileRecord(str):
+    '''
+        A filename, carrying the os.DirEntry it was found with
+        so its type and stat are only read once
+    '''
+
+    entry = None
+    _stat = None
+
+    def __new__(cls, path, entry=None):
+        # Only set when given, as many paths may be read without one
+        record = super().__new__(cls, path)
+        if entry is not None:
+            record.entry = entry
+        return record
+
+    def stat(self):
+        if self._stat is None:
+            if self.entry is not None:
+                self._stat = self.entry.stat()
+            else:
+                self._stat = os.stat(self)
+        return self._stat
+
+    def is_file(self):
+        try:
+            if self.entry is not None:
+                return self.entry.is_file()
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        if self.entry is not None:
+            return self.entry.is_symlink()
+        return os.path.islink(self)
+
+
+class HardLink(str):
+    '''
+        A path to the same file as source, a path found before it.
+        It is grouped with source without the file being filtered again
+    '''
+
+    def __new__(cls, path, source):
+        link = super().__new__(cls, path)
+        link.source = source
+        return link
+
+
+# Stat of a filename, cached if it is a FileRecord
+def file_stat(filename):
+    if isinstance(filename, FileRecord):
+        return filename.stat()
+    return os.stat(filename)
+
+
 def directory_search(directory: str, *,
                      recursive=True, max_depth=None, dir_hidden=None,
                      include=None, exclude=None,
-                     dir_include=None, dir_exclude=None
+                     dir_include=None, dir_exclude=None,
+                     scandir=None, walker=None, null=False
                      ) -> tuple:
     orig_directory = os.path.expanduser(directory)
-    orig_directory_hidden = hidden_in_dir(directory)
+    descend = search_descend(directory, dir_hidden=dir_hidden)
 
-    directory_depth = 0
+    if recursive is False:
+        max_depth = 0
 
     if not os.path.isdir(orig_directory):
-        for file in filenames_from_file(orig_directory):
+        for file in filenames_from_file(orig_directory, null=null):
             yield file
     else:
-        for directory, subdir, files in os.walk(orig_directory):
-
-            # Skip hidden directories if specified
-            if all((
-                    dir_hidden is not True,
-                    orig_directory_hidden is not True,
-                    hidden_in_dir(directory))
-                    ):
-                continue
+        if walker is not None:
+            walked = walker.walk(orig_directory, max_depth=max_depth, descend=descend)
+        else:
+            walked = walk_directory(orig_directory, max_depth=max_depth, descend=descend, scandir=scandir)
+        for directory, files in walked:
 
             # Check for included and excluded directories
             # If directory matches, skip it
@@ -35,24 +97,294 @@ def directory_search(directory: str, *,
                 if not dir_include_exclude(directory, include=dir_include, exclude=dir_exclude):
                     continue
             if include or exclude:
-                for directory, file in file_include_exclude(files,
+                entries = {entry.name: entry for entry in files}
+                for directory, file in file_include_exclude(list(entries),
                                                             directory=directory,
                                                             include=include,
                                                             exclude=exclude
                                                             ):
-                    yield os.path.join(directory, file)
+                    yield FileRecord(os.path.join(directory, file), entries[file])
             else:
-                for file in files:
-                    yield os.path.join(directory, file)
-
-            # Break after 1st iteration to prevent recursiveness
-            # If max-depth is specified, break after specified number
-            if recursive is False:
-                break
-            elif max_depth is int and max_depth > 0:
-                directory_depth += 1
-                if directory_depth == max_depth:
+                for entry in files:
+                    yield FileRecord(entry.path, entry)
+
+
+# Removes directories searched as part of another directory given, keeping the order given
+# Returns the directories left, and whether a file may still be found by more than one of them
+def distinct_roots(directories, *, recursive=True, max_depth=None, dir_hidden=None) -> tuple:
+    if recursive is False:
+        max_depth = 0
+    roots = list()
+    overlapping = False
+    for directory in directories:
+        expanded = os.path.expanduser(directory)
+        # Files listing paths are read as given, a path listed may be listed again or found by another root
+        if not os.path.isdir(expanded):
+            roots.append((directory, None))
+            overlapping = True
+            continue
+        real_directory = os.path.realpath(expanded)
+
+        covered = False
+        for root, real_root in list(roots):
+            if real_root is None:
+                continue
+            # The directory below root, or root below the directory
+            if _searched_below(root, real_root, real_directory, max_depth=max_depth, dir_hidden=dir_hidden):
+                if real_directory == real_root or max_depth is None:
+                    log.info("{dir} is searched as part of {root}".format(dir=directory, root=root))
+                    covered = True
                     break
+                overlapping = True
+            elif _searched_below(directory, real_directory, real_root, max_depth=max_depth, dir_hidden=dir_hidden):
+                if max_depth is None:
+                    log.info("{root} is searched as part of {dir}".format(dir=directory, root=root))
+                    roots.remove((root, real_root))
+                else:
+                    overlapping = True
+        if covered is False:
+            roots.append((directory, real_directory))
+    return [directory for directory, real_directory in roots], overlapping
+
+
+# If searching root finds files of the directory, both given as their real paths
+def _searched_below(root, real_root, real_directory, *, max_depth=None, dir_hidden=None):
+    if real_directory == real_root:
+        return True
+    if not real_directory.startswith(os.path.join(real_root, '')):
+        return False
+    relative = os.path.relpath(real_directory, real_root)
+    if max_depth is not None and relative.count(os.sep) + 1 > max_depth:
+        return False
+    descend = search_descend(root, dir_hidden=dir_hidden)
+    return descend is None or descend(os.path.join(root, relative))
+
+
+# Top down like os.walk, listing each directory once with os.scandir
+# Yields the directory and the os.DirEntry of each non directory in it
+# max_depth limits the number of directories descended below top,
+# descend decides if a subdirectory is walked,
+# scandir replaces os.scandir to list a directory
+def walk_directory(top, *, max_depth=None, descend=None, scandir=None):
+    stack = [(top, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        try:
+            subdirs, files = list_directory(directory, scandir=scandir)
+        except OSError as e:
+            log.warning("Unable to list {dir}: {err}".format(dir=directory, err=e.strerror))
+            continue
+        yield directory, files
+
+        # Reversed, so subdirectories are walked in the order listed
+        for subdir in reversed(walked_subdirs(subdirs, depth, max_depth=max_depth, descend=descend)):
+            stack.append((subdir, depth + 1))
+
+
+# Lists directory, returning the os.DirEntry of each subdirectory and of each other file
+def list_directory(directory, *, scandir=None, sort=False):
+    if scandir is None:
+        scandir = os.scandir
+    entries = list(scandir(directory))
+    if sort is True:
+        entries.sort(key=lambda entry: entry.name)
+
+    subdirs = list()
+    files = list()
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            subdirs.append(entry)
+        else:
+            files.append(entry)
+    return subdirs, files
+
+
+# The paths of the subdirectories of a directory at depth to be walked
+def walked_subdirs(subdirs, depth, *, max_depth=None, descend=None) -> list:
+    if max_depth is not None and depth >= max_depth:
+        return list()
+    walked = list()
+    for entry in subdirs:
+        # Like os.walk, symbolic links to directories are not followed
+        if entry.is_symlink():
+            continue
+        if descend is not None and not descend(entry.path):
+            continue
+        walked.append(entry.path)
+    return walked
+
+
+class ParallelWalker:
+    '''
+        Walks directories like walk_directory, listing up to jobs directories at once.
+        order is one of
+            listed:    the same order as walk_directory
+            sorted:    as listed, with the entries of each directory sorted by name
+            unordered: each directory as soon as it is listed
+        Once a directory is listed its subdirectories are listed ahead of being walked,
+        at most window directories at a time. A directory waited on is listed first,
+        then the most recently found directories, being the next walked
+    '''
+    orders = ('listed', 'sorted', 'unordered')
+
+    def __init__(self, *, jobs=1, order='listed', scandir=None, window=None):
+        self.jobs = max(jobs, 1)
+        self.order = order
+        self.scandir = scandir
+        self.window = window if window is not None else self.jobs * 16
+        # Directory -> future of its listing, listed ahead of being walked
+        self._prefetched = dict()
+        self._waited = deque()
+        self._ahead = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = list()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._waited and not self._ahead and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return None
+                if self._waited:
+                    future, args = self._waited.popleft()
+                else:
+                    future, args = self._ahead.pop()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._list(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _queue(self, tasks, *args):
+        # Adds a listing to tasks, with self._condition held
+        if len(self._threads) < self.jobs:
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        future = Future()
+        tasks.append((future, args))
+        self._condition.notify()
+        return future
+
+    def _list(self, directory, depth, max_depth, descend):
+        listing = list_directory(directory, scandir=self.scandir, sort=self.order == 'sorted')
+        subdirs, files = listing
+        # The first subdirectories are walked next, before the rest of this directory's siblings
+        self._ahead_of([(subdir, depth + 1) for subdir in
+                        walked_subdirs(subdirs, depth, max_depth=max_depth, descend=descend)[:self.jobs]],
+                       max_depth, descend)
+        return listing
+
+    def _ahead_of(self, directories, max_depth, descend):
+        # Lists (directory, depth) ahead of being walked, first needed first, within the window
+        with self._condition:
+            if self._closed:
+                return None
+            directories = [(directory, depth) for directory, depth in directories
+                           if directory not in self._prefetched]
+            del directories[max(self.window - len(self._prefetched), 0):]
+            # The most recently added are listed first
+            for directory, depth in reversed(directories):
+                self._prefetched[directory] = self._queue(self._ahead, directory, depth, max_depth, descend)
+
+    def _submit(self, directory, depth, max_depth, descend):
+        with self._condition:
+            future = self._prefetched.pop(directory, None)
+            if future is None:
+                future = self._queue(self._waited, directory, depth, max_depth, descend)
+        return future
+
+    def prefetch(self, directory, *, max_depth=None, descend=None):
+        # Starts listing directory before it is walked, such as each directory searched
+        with self._condition:
+            if directory not in self._prefetched:
+                self._prefetched[directory] = self._queue(self._ahead, directory, 0, max_depth, descend)
+
+    def walk(self, top, *, max_depth=None, descend=None):
+        if self.order == 'unordered':
+            return self._walk_unordered(top, max_depth=max_depth, descend=descend)
+        return self._walk_ordered(top, max_depth=max_depth, descend=descend)
+
+    def _result(self, directory, future):
+        try:
+            return future.result()
+        except OSError as e:
+            log.warning("Unable to list {dir}: {err}".format(dir=directory, err=e.strerror))
+            return None
+
+    def _walk_ordered(self, top, *, max_depth, descend):
+        stack = [(top, 0)]
+        while stack:
+            directory, depth = stack.pop()
+            listing = self._result(directory, self._submit(directory, depth, max_depth, descend))
+            if listing is None:
+                continue
+            subdirs, files = listing
+            # Reversed, so subdirectories are walked in the order listed
+            for subdir in reversed(walked_subdirs(subdirs, depth, max_depth=max_depth, descend=descend)):
+                stack.append((subdir, depth + 1))
+            # The next directories walked
+            self._ahead_of(stack[:-self.jobs - 1:-1], max_depth, descend)
+            yield directory, files
+
+    def _walk_unordered(self, top, *, max_depth, descend):
+        waiting = deque()
+        running = {self._submit(top, 0, max_depth, descend): (top, 0)}
+        try:
+            while running:
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory, depth = running.pop(future)
+                    listing = self._result(directory, future)
+                    if listing is None:
+                        continue
+                    subdirs, files = listing
+                    for subdir in walked_subdirs(subdirs, depth, max_depth=max_depth, descend=descend):
+                        waiting.append((subdir, depth + 1))
+                    while waiting and len(running) < self.window:
+                        subdir, subdir_depth = waiting.popleft()
+                        running[self._submit(subdir, subdir_depth, max_depth, descend)] = (subdir, subdir_depth)
+                    yield directory, files
+        finally:
+            for future in running:
+                future.cancel()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            for future, args in list(self._waited) + list(self._ahead):
+                future.cancel()
+            self._prefetched.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+def search_descend(directory, *, dir_hidden=None):
+    # Skip hidden directories if specified, along with everything below them
+    # unless the directory searched is itself hidden
+    if dir_hidden is not True and hidden_in_dir(directory) is not True:
+        return negation(hidden_in_dir)
+    return None
+
+
+# Applies the include and exclude options of directory_search to a single file
+def file_searched(path, *, include=None, exclude=None, dir_include=None, dir_exclude=None):
+    directory, filename = os.path.split(path)
+    if dir_include or dir_exclude:
+        if not dir_include_exclude(directory, include=dir_include, exclude=dir_exclude):
+            return False
+    if include or exclude:
+        return any(True for _ in file_include_exclude([filename], directory=directory,
+                                                      include=include, exclude=exclude))
+    return True
 
 
 def dir_include_exclude(directory, *, include=None, exclude=None):
@@ -117,31 +449,58 @@ def hidden_in_dir(directory):
         return False
 
 
-def filenames_from_file(file):
-    with open(file) as f:
-        # Trial a initial line from file to see if it is valid, with additional checks
+def filenames_from_file(file, *, null=False):
+    with open(file, 'rb', buffering=0) as f:
+        # Trial the initial filename from file to see if it is valid,
         # if it fails, consider it a bad file and crash
-        # If it is valid, on subsequent invalid filenames just skip
-        try:
-            initial_line = next(f)
-            initial_line = initial_line.rstrip()
-        except UnicodeDecodeError:
-            log.error("'{}' is not a valid file".format(file))
+        # Later filenames are not checked, the conditions skip those not found
+        filenames = read_filenames(f, null=null)
+        initial_filename = next(filenames, None)
+        if initial_filename is None or not os.path.exists(initial_filename):
+            if null is True:
+                print("Each filename must be followed by a NUL character")
+            else:
+                print("Each line must be a filename")
             exit(1)
 
         log.info("Reading from '{file}'".format(file=file))
-        if os.path.exists(initial_line):
-            yield initial_line
-        else:
-            print("Each line must be a filename")
-            exit(1)
+        yield initial_filename
+        for filename in filenames:
+            yield filename
 
-        for line in f:
-            file = line.rstrip()
-            if os.path.exists(file):
-                yield file
-            else:
-                log.warning("File '{}' not found, skipping".format(file))
+
+# Reads filenames from an unbuffered binary file, as each block of up to block_size bytes arrives
+# Separated by NUL characters, or by newlines. Names are decoded as os.fsdecode does,
+# bytes that are not valid in the filesystem encoding are kept with surrogateescape
+def read_filenames(file, *, null=False, block_size=1048576):
+    separator = '\0' if null is True else '\n'
+    remainder = b''
+    while True:
+        block = file.read(block_size)
+        data = remainder + block
+        # The last name may continue in the next block, unless the file has ended
+        end = data.rfind(separator.encode()) + 1 if block else len(data)
+        remainder = data[end:]
+        # Each block is decoded at once, rather than each name
+        for filename in os.fsdecode(data[:end]).split(separator):
+            if null is False:
+                filename = filename.rstrip('\r')
+            if filename:
+                yield FileRecord(filename)
+        if not block:
+            break
+
+
+# Filenames listed in file, or standard input for '-'
+def filenames_from(file, *, null=False):
+    if file == '-':
+        for filename in read_filenames(sys.stdin.buffer.raw, null=null):
+            yield filename
+        return None
+    with open(file, 'rb', buffering=0) as f:
+        log.info("Reading from '{file}'".format(file=file))
+        for filename in read_filenames(f, null=null):
+            yield filename
 
 
 if __name__ == '__main__':
@@ -0,0 +1,262 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from util.DirectorySearch import file_stat
+
+log = logging.getLogger(__name__)
+
+# Rows are written in batches, committing every _commit_interval writes
+_commit_interval = 1000
+# last_used is only updated once it is older than this, in seconds
+_touch_interval = 24 * 60 * 60
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'groupby', 'filters.sqlite3')
+
+
+# SQLite integers are signed 64 bit, st_dev and st_ino may use the full unsigned range
+def _signed(number):
+    if number >= 2 ** 63:
+        return number - 2 ** 64
+    return number
+
+
+def _spec_bytes(spec):
+    if isinstance(spec, bytes):
+        return spec
+    return spec.encode('utf-8', errors='surrogateescape')
+
+
+def _unchanged(row, stat) -> bool:
+    # row starts with the size, mtime_ns and ctime_ns stored
+    return row[0] == stat.st_size and row[1] == stat.st_mtime_ns and row[2] == stat.st_ctime_ns
+
+
+class FilterCache:
+    '''
+        Stores filter output keyed by file identity
+        (st_dev, st_ino, filter spec), validated against st_size, st_mtime_ns and st_ctime_ns.
+        The mtime of a file can be set back after changing it, its ctime can't
+    '''
+
+    def __init__(self):
+        self.connection = None
+        self.path = None
+        self.max_age = None
+        self.max_size = None
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._touched = list()
+        # Also held by a Snapshot sharing the connection
+        self.lock = threading.Lock()
+        # False when only a Snapshot uses the connection, filter output is neither read nor written
+        self.keep_output = True
+        # Tables with a last_used column, evicted by max_age and max_size
+        self.tables = ['filter_output']
+
+    @property
+    def enabled(self):
+        return self.connection is not None and self.keep_output is True
+
+    def open(self, path, *, max_age=None, max_size=None, keep_output=True):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.keep_output = keep_output
+        self.tables = ['filter_output']
+        try:
+            cache_dir = os.path.dirname(os.path.abspath(path))
+            os.makedirs(cache_dir, exist_ok=True)
+            connection = sqlite3.connect(path, check_same_thread=False)
+            # Caches written before ctime_ns was stored can't be validated, their output is dropped
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(filter_output)')]
+            if columns and 'ctime_ns' not in columns:
+                connection.execute('DROP TABLE filter_output')
+            connection.execute('''CREATE TABLE IF NOT EXISTS filter_output (
+                                    dev       INTEGER NOT NULL,
+                                    ino       INTEGER NOT NULL,
+                                    spec      BLOB    NOT NULL,
+                                    size      INTEGER NOT NULL,
+                                    mtime_ns  INTEGER NOT NULL,
+                                    ctime_ns  INTEGER NOT NULL,
+                                    output,
+                                    last_used INTEGER NOT NULL,
+                                    UNIQUE (dev, ino, spec)
+                                  )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS filter_output_last_used '
+                               'ON filter_output (last_used)')
+            connection.commit()
+        except (OSError, sqlite3.Error) as e:
+            log.warning("Filter cache '{path}' unavailable: {err}".format(path=path, err=e))
+            return None
+        self.connection = connection
+        log.debug("Using filter cache '{}'".format(path))
+        return self
+
+    def get(self, stat, spec):
+        key = (_signed(stat.st_dev), _signed(stat.st_ino), _spec_bytes(spec))
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT size, mtime_ns, ctime_ns, output, last_used FROM filter_output '
+                'WHERE dev = ? AND ino = ? AND spec = ?', key).fetchone()
+            if row is not None and _unchanged(row, stat):
+                self.hits += 1
+                now = int(time.time())
+                if now - row[4] > _touch_interval:
+                    self._touched.append((now,) + key)
+                return row[3]
+            self.misses += 1
+            return None
+
+    def contains(self, stat, spec) -> bool:
+        # As get, without counting a hit or miss
+        key = (_signed(stat.st_dev), _signed(stat.st_ino), _spec_bytes(spec))
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT size, mtime_ns, ctime_ns FROM filter_output '
+                'WHERE dev = ? AND ino = ? AND spec = ?', key).fetchone()
+        return row is not None and _unchanged(row, stat)
+
+    def set(self, stat, spec, output):
+        row = (_signed(stat.st_dev), _signed(stat.st_ino), _spec_bytes(spec),
+               stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, output, int(time.time()))
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO filter_output '
+                '(dev, ino, spec, size, mtime_ns, ctime_ns, output, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self._writes += 1
+            if self._writes % _commit_interval == 0:
+                self._flush()
+
+    def _flush(self):
+        if self._touched:
+            self.connection.executemany(
+                'UPDATE filter_output SET last_used = ? '
+                'WHERE dev = ? AND ino = ? AND spec = ?', self._touched)
+            self._touched = list()
+        self.connection.commit()
+
+    def _evict(self):
+        evicted = 0
+        if self.max_age is not None:
+            oldest = int(time.time() - self.max_age)
+            for table in self.tables:
+                evicted += self.connection.execute(
+                    'DELETE FROM {table} WHERE last_used < ?'.format(table=table), (oldest,)).rowcount
+        if self.max_size is not None:
+            page_size = self.connection.execute('PRAGMA page_size').fetchone()[0]
+            page_count = self.connection.execute('PRAGMA page_count').fetchone()[0]
+            db_size = page_size * page_count
+            if db_size > self.max_size:
+                # Remove the same share of the least recently used rows of each table,
+                # leaving some headroom under max_size
+                for table in self.tables:
+                    row_count = self.connection.execute(
+                        'SELECT COUNT(*) FROM {table}'.format(table=table)).fetchone()[0]
+                    keep = int(row_count * (self.max_size / db_size) * 0.9)
+                    evicted += self.connection.execute(
+                        'DELETE FROM {table} WHERE rowid IN '
+                        '(SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)'.format(table=table),
+                        (row_count - keep,)).rowcount
+                self.connection.commit()
+                self.connection.execute('VACUUM')
+        return evicted
+
+    def close(self):
+        if self.connection is None:
+            return None
+        with self.lock:
+            try:
+                self._flush()
+                evicted = self._evict()
+                self.connection.commit()
+            except sqlite3.Error as e:
+                log.warning("Filter cache '{path}' could not be saved: {err}".format(path=self.path, err=e))
+                evicted = 0
+            self.connection.close()
+            self.connection = None
+        log.info("Filter cache: {hits} hits, {misses} misses, {evicted} evicted".format(
+            hits=self.hits,
+            misses=self.misses,
+            evicted=evicted))
+
+
+class CachedFilter:
+    '''
+        Wraps a filter, its output is looked up in filter_cache
+        before the filter is called on the file.
+        spec identifies the filter, or is a callable taking the filename
+        for filters whose output also depends on the filename
+    '''
+
+    def __init__(self, func, *, spec):
+        self.func = func
+        self.spec = spec
+        # Filters able to take many files at once keep doing so
+        if getattr(func, 'batch', None) is not None:
+            self.batch = self._batch
+        else:
+            self.batch = None
+
+    def __repr__(self):
+        return '{cls}({func!r}, spec={spec!r})'.format(cls=type(self).__name__, func=self.func, spec=self.spec)
+
+    def __call__(self, filename):
+        if not filter_cache.enabled:
+            return self.func(filename)
+        try:
+            stat = file_stat(filename)
+        except OSError:
+            return self.func(filename)
+
+        spec = self.spec(filename) if callable(self.spec) else self.spec
+        output = filter_cache.get(stat, spec)
+        if output is None:
+            output = self.func(filename)
+            filter_cache.set(stat, spec, output)
+        return output
+
+    def cached(self, filename) -> bool:
+        # If the output for filename is in the cache, so the filter won't read the file
+        if not filter_cache.enabled:
+            return False
+        try:
+            stat = file_stat(filename)
+        except OSError:
+            return False
+        return filter_cache.contains(stat, self.spec(filename) if callable(self.spec) else self.spec)
+
+    def _batch(self, filenames):
+        if not filter_cache.enabled:
+            return self.func.batch(filenames)
+
+        outputs = list()
+        uncached = list()
+        for filename in filenames:
+            try:
+                stat = file_stat(filename)
+            except OSError:
+                stat = None
+            spec = self.spec(filename) if callable(self.spec) else self.spec
+            output = filter_cache.get(stat, spec) if stat is not None else None
+            if output is None:
+                uncached.append((len(outputs), filename, stat, spec))
+            outputs.append(output)
+
+        if uncached:
+            uncached_outputs = self.func.batch([filename for index, filename, stat, spec in uncached])
+            for (index, filename, stat, spec), output in zip(uncached, uncached_outputs):
+                outputs[index] = output
+                if stat is not None:
+                    filter_cache.set(stat, spec, output)
+        return outputs
+
+
+filter_cache = FilterCache()
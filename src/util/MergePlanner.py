@@ -0,0 +1,126 @@
+import logging
+import os
+from collections import OrderedDict
+
+from util.DirectorySearch import file_stat
+from util.Templates import sanitize_object
+
+log = logging.getLogger(__name__)
+
+# Replace a conflicting file when the file merged is ..., compared with the file merged before it
+conditions = {
+    'LARGER' : lambda stat, existing: stat.st_size > existing.st_size,
+    'SMALLER': lambda stat, existing: stat.st_size < existing.st_size,
+    'NEWER'  : lambda stat, existing: stat.st_mtime > existing.st_mtime,
+    'OLDER'  : lambda stat, existing: stat.st_mtime < existing.st_mtime,
+}
+overwrite_modifiers = ('COUNT', 'IGNORE', 'ERROR') + tuple(conditions)
+
+
+class MergeTarget:
+    '''
+        The names taken in a directory merged into, listed from it once.
+        Each name is kept with the stat of the file taking it, or the os.DirEntry it was listed with
+    '''
+    __slots__ = ('directory', 'names', 'counters')
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = dict()
+        # Name -> last count used to rename a file conflicting with it
+        self.counters = dict()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    self.names[entry.name] = entry
+        except OSError:
+            pass
+
+    def stat(self, name):
+        taken = self.names[name]
+        if isinstance(taken, os.DirEntry):
+            taken = self.names[name] = taken.stat()
+        return taken
+
+    def free_name(self, name) -> str:
+        # foo.mkv -> foo_0001.mkv, counting on from the last name given for foo.mkv
+        stem, extension = os.path.splitext(name)
+        count = self.counters.get(name, 0)
+        while True:
+            count += 1
+            free = '{stem}_{count}{extension}'.format(stem=stem, count=str(count).zfill(4), extension=extension)
+            if free not in self.names:
+                self.counters[name] = count
+                return free
+
+
+class MergePlanner:
+    '''
+        Decides where each file of a group is merged to, before any file is copied.
+        Conflicts are resolved with the names taken in each directory, kept in memory,
+        and the stat of the files merged, so the disk is only read to list each directory once.
+        A name replaced more than once in a group is only copied once
+    '''
+
+    def __init__(self, merge_dir, *, overwrite='COUNT'):
+        assert overwrite in overwrite_modifiers
+        self.merge_dir = merge_dir
+        self.overwrite = overwrite
+        # Directory -> its MergeTarget
+        self._targets = dict()
+
+    def _target(self, directory) -> MergeTarget:
+        target = self._targets.get(directory)
+        if target is None:
+            target = self._targets[directory] = MergeTarget(directory)
+        return target
+
+    def plan(self, directory, group) -> tuple:
+        # Returns the destination of each file in the order decided,
+        # and the (source, destination, replace) to carry out
+        target = self._target(directory)
+        destinations = list()
+        # Name -> (source, replace)
+        transfers = OrderedDict()
+        for source in group:
+            name = os.path.split(source)[1]
+            stat = file_stat(source)
+            if name not in target.names:
+                target.names[name] = stat
+                transfers[name] = (source, False)
+            elif self.overwrite == 'COUNT':
+                free = target.free_name(name)
+                log.info('Incrementing {} to {}'.format(sanitize_object(name), sanitize_object(free)))
+                target.names[free] = stat
+                transfers[free] = (source, False)
+                name = free
+            elif self.overwrite == 'IGNORE':
+                log.info("{} Exists, Ignoring {}".format(sanitize_object(os.path.join(directory, name)),
+                                                         sanitize_object(source)))
+                continue
+            elif self.overwrite == 'ERROR':
+                log.error('{} already exists, exiting'.format(sanitize_object(os.path.join(directory, name))))
+                exit(1)
+            elif conditions[self.overwrite](stat, target.stat(name)):
+                log.info("{} overwriting {}".format(sanitize_object(source),
+                                                    sanitize_object(os.path.join(directory, name))))
+                target.names[name] = stat
+                # Only replaced on disk if the name was taken before this group
+                transfers[name] = (source, transfers.get(name, (None, True))[1])
+            else:
+                continue
+            destinations.append(os.path.join(directory, name))
+        return destinations, [(source, os.path.join(directory, name), replace)
+                              for name, (source, replace) in transfers.items()]
+
+    @staticmethod
+    def execute(transfers, engine):
+        if not transfers:
+            return None
+        os.makedirs(os.path.dirname(transfers[0][1]), exist_ok=True)
+        for source, destination, replace in transfers:
+            engine.transfer(source, destination, replace=replace)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,124 @@
+import csv
+import io
+import json
+import logging
+import os
+import sys
+
+from util.DirectorySearch import file_stat
+
+log = logging.getLogger(__name__)
+
+# human: the grouped results as printed by default
+# jsonl: a JSON object for each file
+# null:  each filename followed by a NUL, each group followed by another NUL
+# csv:   a row for each file, after a header row
+formats = ('human', 'jsonl', 'null', 'csv')
+
+# Bytes written to standard output at once
+_buffer_size = 1048576
+_fields = ('group', 'path', 'size', 'inode', 'device')
+# Paths that aren't valid UTF-8 are escaped as \udcXX, as os.fsdecode read them
+_encode = json.JSONEncoder().encode
+
+
+def _stat_fields(path) -> tuple:
+    try:
+        stat = file_stat(path)
+    except OSError:
+        return None, None, None
+    return stat.st_size, stat.st_ino, stat.st_dev
+
+
+def _label(filter_output) -> str:
+    # Shell filters give bytes
+    if isinstance(filter_output, bytes):
+        return os.fsdecode(filter_output)
+    return filter_output
+
+
+class GroupWriter:
+    '''
+        The group action with --format, writing each file of each group as a record for other programs.
+        Records of many groups are written to standard output at once, through one buffer.
+        Each group is numbered in the order found, with --stream a group is numbered once
+        and each update of it only writes the files that joined it
+    '''
+    source_first = True
+
+    def __init__(self, output_format, *, stream=False, file=None):
+        assert output_format in formats and output_format != 'human'
+        self.stream = stream
+        self._count = 0
+        # First file of a group -> its number, only kept while streaming
+        self._numbers = dict()
+        if file is None:
+            file = open(sys.stdout.fileno(), 'wb', buffering=_buffer_size, closefd=False)
+        self._file = file
+        self._write = file.write
+        self._csv = None
+        self._header = output_format == 'csv'
+        if output_format == 'csv':
+            # Written straight through to the buffer of the binary file
+            self._text = io.TextIOWrapper(file, encoding='utf-8', errors='surrogateescape',
+                                          newline='', write_through=True)
+            self._csv = csv.writer(self._text, lineterminator='\n')
+        self._records = {'jsonl': self._jsonl, 'null': self._null, 'csv': self._csv_rows}[output_format]
+
+    def __call__(self, filtered_group, *, labeled_filters):
+        number = self._numbers.get(filtered_group[0]) if self.stream is True else None
+        if number is None:
+            self._count += 1
+            number = self._count
+            if self.stream is True:
+                self._numbers[filtered_group[0]] = number
+            filenames = filtered_group
+        else:
+            # The first file was written when the group was found
+            filenames = filtered_group[1:]
+        self._records(number, filenames, labeled_filters)
+        if self.stream is True:
+            self.flush()
+        return None
+
+    def _jsonl(self, number, filenames, labeled_filters):
+        # Only the path of each file is encoded, the rest of the record is the same for the group
+        # or a number, giving the same line as json.dumps of the record
+        prefix = '{{"group": {}, "path": '.format(number)
+        suffix = ''.join(', {}: {}'.format(_encode(label), _encode(_label(filter_output)))
+                         for label, filter_output in labeled_filters.items()) + '}\n'
+        lines = list()
+        for path in filenames:
+            size, inode, device = _stat_fields(path)
+            if size is None:
+                fields = ', "size": null, "inode": null, "device": null'
+            else:
+                fields = ', "size": {}, "inode": {}, "device": {}'.format(size, inode, device)
+            lines.append(prefix + _encode(path) + fields + suffix)
+        self._write(''.join(lines).encode('ascii'))
+
+    def _null(self, number, filenames, labeled_filters):
+        self._write(b''.join(os.fsencode(path) + b'\0' for path in filenames) + b'\0')
+
+    def _csv_rows(self, number, filenames, labeled_filters):
+        labels = [_label(filter_output) for filter_output in labeled_filters.values()]
+        if self._header is True:
+            self._header = False
+            self._csv.writerow(_fields + tuple(labeled_filters))
+        rows = list()
+        for path in filenames:
+            rows.append([number, path, *_stat_fields(path), *labels])
+        self._csv.writerows(rows)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        try:
+            self.flush()
+        except BrokenPipeError:
+            pass
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,59 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+def ordered_map(func, iterable, *, jobs=1, window=None):
+    '''
+        Like map(), results are returned in the order of iterable
+        while up to jobs calls of func run at once.
+        At most window items are read ahead of the results returned.
+    '''
+    if jobs is None or jobs <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    if window is None:
+        window = jobs * 4
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # If an error occurred or the results are no longer wanted,
+        # start no new work but let calls already running finish
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def batched_map(func, iterable, *, size, jobs=1):
+    '''
+        func is called with lists of up to size items, returning a list with a result for each.
+        Each item is returned with its result, in the order of iterable
+    '''
+    def batches():
+        batch = list()
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+    for batch, results in ordered_map(lambda batch: (batch, func(batch)), batches(), jobs=jobs):
+        for item, result in zip(batch, results):
+            yield item, result
+
+
+if __name__ == '__main__':
+    pass
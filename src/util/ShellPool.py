@@ -0,0 +1,127 @@
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class ShellWorker:
+    '''
+        A long running shell, commands are written to its stdin and run in a subshell.
+        Each command is followed by a marker unique to this shell and the exit status,
+        marking the end of the command's output
+    '''
+
+    def __init__(self, shell='/bin/sh'):
+        self.marker = 'groupby-{}'.format(os.urandom(16).hex()).encode()
+        self.process = subprocess.Popen([shell], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # Output read past the end of the last command, grown in place as it is read
+        self._buffer = bytearray()
+
+    def run(self, command: str) -> tuple:
+        # Quoted and run with eval in a subshell, so neither a syntax error,
+        # exit or cd in the command affects the shell itself
+        script = '( eval {command} ) </dev/null; printf "%s:%d\\n" {marker} "$?"\n'.format(
+            command=shlex.quote(command),
+            marker=self.marker.decode())
+        self.process.stdin.write(script.encode(sys.getfilesystemencoding(), errors='surrogateescape'))
+        self.process.stdin.flush()
+
+        stdout = self.process.stdout.fileno()
+        marker = self.marker + b':'
+        # Output already searched isn't searched again, other than the start of a marker split across reads
+        start = 0
+        while True:
+            marker_index = self._buffer.find(marker, start)
+            if marker_index != -1:
+                start = marker_index
+                status_end = self._buffer.find(b'\n', marker_index)
+                if status_end != -1:
+                    break
+            else:
+                start = max(len(self._buffer) - len(marker) + 1, 0)
+            data = os.read(stdout, 65536)
+            if not data:
+                raise subprocess.CalledProcessError(self.process.wait(), command, output=bytes(self._buffer))
+            self._buffer += data
+
+        output = bytes(self._buffer[:marker_index])
+        returncode = int(self._buffer[marker_index + len(self.marker) + 1:status_end])
+        self._buffer = self._buffer[status_end + 1:]
+        return returncode, output
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class ShellPool:
+    '''
+        Up to size ShellWorkers, started as needed and reused for every command.
+        check_output is used in place of subprocess.check_output(command, shell=True)
+    '''
+
+    def __init__(self, size=1, shell='/bin/sh'):
+        self.size = max(size, 1)
+        self.shell = shell
+        self._workers = list()
+        # Shells not running a command, the most recently used last
+        self._idle = list()
+        self._condition = threading.Condition()
+
+    def _acquire(self) -> ShellWorker:
+        # An idle shell, or a new one while fewer than size are running, otherwise waits for either
+        with self._condition:
+            while not self._idle and len(self._workers) >= self.size:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            worker = ShellWorker(self.shell)
+            self._workers.append(worker)
+        log.debug("Started shell {}".format(worker.process.pid))
+        return worker
+
+    def _release(self, worker):
+        with self._condition:
+            self._idle.append(worker)
+            self._condition.notify()
+
+    def _discard(self, worker):
+        with self._condition:
+            self._workers.remove(worker)
+            # A thread waiting starts a shell in its place
+            self._condition.notify()
+        worker.close()
+
+    def check_output(self, command: str) -> bytes:
+        worker = self._acquire()
+        try:
+            returncode, output = worker.run(command)
+        except BaseException:
+            # The shell may be part way through a command, it can't be reused
+            self._discard(worker)
+            raise
+        self._release(worker)
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, output=output)
+        return output
+
+    def close(self):
+        with self._condition:
+            workers = self._workers
+            self._workers = list()
+            self._idle = list()
+        for worker in workers:
+            worker.close()
+
+
+if __name__ == '__main__':
+    pass
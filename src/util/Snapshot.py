@@ -0,0 +1,143 @@
+import logging
+import os
+import sqlite3
+import time
+
+from util.FilterCache import filter_cache
+
+log = logging.getLogger(__name__)
+
+# last_used of a listing is only updated once it is older than this, in seconds, as with filter output
+_touch_interval = 24 * 60 * 60
+
+# Type of each entry, stored as one byte for each name
+_IS_DIR = 1
+_IS_FILE = 2
+_IS_SYMLINK = 4
+
+
+class SnapshotEntry:
+    '''
+        Stands in for the os.DirEntry of a directory listing read from a snapshot
+    '''
+    __slots__ = ('name', 'path', '_flags')
+
+    def __init__(self, directory, name, flags):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._flags = flags
+
+    def __repr__(self):
+        return '<{cls} {name!r}>'.format(cls=type(self).__name__, name=self.name)
+
+    def is_dir(self):
+        return bool(self._flags & _IS_DIR)
+
+    def is_file(self):
+        return bool(self._flags & _IS_FILE)
+
+    def is_symlink(self):
+        return bool(self._flags & _IS_SYMLINK)
+
+    def stat(self, *, follow_symlinks=True):
+        return os.stat(self.path, follow_symlinks=follow_symlinks)
+
+
+def _entry_flags(entry):
+    flags = 0
+    for flag, check in ((_IS_DIR, entry.is_dir), (_IS_FILE, entry.is_file), (_IS_SYMLINK, entry.is_symlink)):
+        try:
+            if check():
+                flags |= flag
+        except OSError:
+            pass
+    return flags
+
+
+class Snapshot:
+    '''
+        The listing of each directory searched, kept with the directory's st_mtime_ns.
+        A directory is only listed again once its mtime changes.
+        Stored in the filter cache database, so filter output is kept in the same file,
+        and listings are evicted along with filter output by max_age and max_size
+    '''
+
+    def __init__(self):
+        self.connection = None
+        self.path = None
+        self.unchanged = 0
+        self.listed = 0
+
+    @property
+    def enabled(self):
+        return self.connection is not None
+
+    def open(self, path, *, max_age=None, max_size=None, keep_output=True):
+        if filter_cache.open(path, max_age=max_age, max_size=max_size, keep_output=keep_output) is None:
+            return None
+        try:
+            with filter_cache.lock:
+                connection = filter_cache.connection
+                # Snapshots written before last_used was stored can't be evicted, their listings are dropped
+                columns = [row[1] for row in connection.execute('PRAGMA table_info(directory_listing)')]
+                if columns and 'last_used' not in columns:
+                    connection.execute('DROP TABLE directory_listing')
+                connection.execute('''CREATE TABLE IF NOT EXISTS directory_listing (
+                                        directory BLOB    PRIMARY KEY,
+                                        mtime_ns  INTEGER NOT NULL,
+                                        names     BLOB    NOT NULL,
+                                        flags     BLOB    NOT NULL,
+                                        last_used INTEGER NOT NULL
+                                      )''')
+                connection.execute('CREATE INDEX IF NOT EXISTS directory_listing_last_used '
+                                   'ON directory_listing (last_used)')
+                connection.commit()
+                filter_cache.tables.append('directory_listing')
+        except sqlite3.Error as e:
+            log.warning("Snapshot '{path}' unavailable: {err}".format(path=path, err=e))
+            return None
+        self.connection = filter_cache.connection
+        self.path = path
+        log.debug("Using snapshot '{}'".format(path))
+        return self
+
+    def scandir(self, directory) -> list:
+        # Like list(os.scandir(directory)), from the snapshot when the directory is unchanged
+        # The mtime is read before listing, a change made while listing is seen next time
+        mtime_ns = os.stat(directory).st_mtime_ns
+        key = os.fsencode(directory)
+        with filter_cache.lock:
+            row = self.connection.execute(
+                'SELECT mtime_ns, names, flags, last_used FROM directory_listing WHERE directory = ?',
+                (key,)).fetchone()
+            now = int(time.time())
+            if row is not None and row[0] == mtime_ns and now - row[3] > _touch_interval:
+                self.connection.execute('UPDATE directory_listing SET last_used = ? WHERE directory = ?',
+                                        (now, key))
+        if row is not None and row[0] == mtime_ns:
+            self.unchanged += 1
+            names = row[1].split(b'\0') if row[1] else list()
+            return [SnapshotEntry(directory, os.fsdecode(name), flags)
+                    for name, flags in zip(names, row[2])]
+
+        entries = list(os.scandir(directory))
+        names = b'\0'.join(os.fsencode(entry.name) for entry in entries)
+        flags = bytes(_entry_flags(entry) for entry in entries)
+        with filter_cache.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO directory_listing (directory, mtime_ns, names, flags, last_used) '
+                'VALUES (?, ?, ?, ?, ?)', (key, mtime_ns, names, flags, int(time.time())))
+        self.listed += 1
+        return entries
+
+    def close(self):
+        # The filter cache commits and closes the connection
+        if self.connection is None:
+            return None
+        self.connection = None
+        log.info("Snapshot: {unchanged} directories unchanged, {listed} listed".format(
+            unchanged=self.unchanged,
+            listed=self.listed))
+
+
+snapshot = Snapshot()
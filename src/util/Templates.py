@@ -56,10 +56,18 @@ class BraceExpansion(string.Formatter):
         {/} : basename of filename
         {//}: dirname of file
         {/.}: dirname of file with extension removed
+        {+} : every filename of a batch
     '''
 
     def __init__(self, template):
         self.template = template
+        # With {+}, called with a list of filenames instead of a filename
+        self.batch = '{+}' in template
+        if self.batch is True and any(alias in template
+                                      for alias in self.aliases().keys()
+                                      if alias != '{+}'):
+            print("{+} can not be used with other filename notation")
+            exit(1)
         for key, alias in self.aliases().items():
             self.template = self.template.replace(key, alias)
 
@@ -79,6 +87,7 @@ class BraceExpansion(string.Formatter):
             '{//}': '{0:c}',
             '{/.}': '{0:e}',
             '{..}': '{0:f}',
+            '{+}': '{0:l}',
         }
         return aliases
 
@@ -114,6 +123,10 @@ class BraceExpansion(string.Formatter):
             ext = os.path.splitext(value)[1]
             value = ext
             spec = spec[:-1] + 's'
+        # {+} notation: every filename, space separated
+        if spec.endswith("l"):
+            value = ' '.join(value)
+            spec = spec[:-1] + 's'
         return super().format_field(value, spec)
 
 
@@ -123,27 +136,47 @@ class EscapedBraceExpansion(BraceExpansion):
 
     # This captures all brace expansion {} and {fn}
     def format_field(self, value, spec):
+        # {+} notation: each filename is escaped on its own
+        if spec.endswith("l"):
+            return ' '.join(self.format_field(filename, spec[:-1] + 'z') for filename in value)
         value = super().format_field(value, spec)
         shell_escape_value = shlex.quote(value)
         return shell_escape_value
 
 
+# When set, shell commands are run by a ShellPool instead of a new shell each time
+_shell_pool = None
+
+
+def set_shell_pool(shell_pool):
+    global _shell_pool
+    _shell_pool = shell_pool
+
+
+class ShellCommandError(Exception):
+    '''
+        Raised when a command run by invoke_shell fails.
+        Commands are run by many threads at once, so only the first raised is logged, by groupby
+    '''
+
+
 def invoke_shell(*args, command, labeled_filters=None, **kwargs) -> bytes:
     # If any extra named arguments provided, use labeled_filters to carry it
     if labeled_filters is not None:
         kwargs.update(labeled_filters)
     try:
-        output = subprocess.check_output(command(*args, **kwargs), shell=True)
+        if _shell_pool is not None:
+            output = _shell_pool.check_output(command(*args, **kwargs))
+        else:
+            output = subprocess.check_output(command(*args, **kwargs), shell=True)
     except subprocess.CalledProcessError as e:
         msg = 'Command: "{cmd}" generated a code [{code}]\n' \
               'Output: {output}'
-        log.error(msg.format(cmd=sanitize_object(e.cmd),
-                             code=e.returncode,
-                             output=sanitize_object(e.output)))
-        exit(1)
+        raise ShellCommandError(msg.format(cmd=sanitize_object(e.cmd),
+                                           code=e.returncode,
+                                           output=sanitize_object(e.output)))
     except KeyError as e:
-        log.error("Filter {}, not found".format(e))
-        exit(1)
+        raise ShellCommandError("Filter {}, not found".format(e))
     return output
 
 
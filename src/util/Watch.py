@@ -0,0 +1,196 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+
+from util.DirectorySearch import search_descend, walk_directory
+from util.Templates import sanitize_object
+
+log = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+              IN_ONLYDIR | IN_DONT_FOLLOW
+
+# struct inotify_event: int wd, uint32_t mask, cookie, len, followed by len bytes of name
+_event = struct.Struct('iIII')
+
+# Events of a file
+CREATED = 'created'
+DELETED = 'deleted'
+# Events of a directory and everything below it
+DELETED_TREE = 'deleted tree'
+# Events were lost, every watched root must be searched again
+OVERFLOW = 'overflow'
+
+
+class Inotify:
+    '''
+        The Linux inotify API through ctypes
+    '''
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        try:
+            self._libc = ctypes.CDLL(libc_name, use_errno=True)
+            self._libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+            self._libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+            self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None) -> list:
+        # Waits for events, returning each as (wd, mask, cookie, name)
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return list()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return list()
+
+        events = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    '''
+        Watches every directory under the roots, as directory_search would walk them.
+        Iterating yields (event, path) as files are written, moved or deleted
+    '''
+
+    def __init__(self, roots, *, max_depth=None, dir_hidden=None):
+        self.max_depth = max_depth
+        self.roots = list(roots)
+        self._inotify = Inotify()
+        # Watch descriptor -> (directory, depth below its root, descend of its root)
+        self._directories = dict()
+        self._watches = dict()
+        # Files already present are found by searching the roots as usual
+        for root in self.roots:
+            for _ in self._watch_tree(root, 0, search_descend(root, dir_hidden=dir_hidden)):
+                pass
+
+    def _watch_tree(self, top, top_depth, descend):
+        # Adds a watch for top and every directory below it, yielding the files found
+        max_depth = None if self.max_depth is None else self.max_depth - top_depth
+        for directory, files in walk_directory(top, max_depth=max_depth, descend=descend):
+            if directory == top:
+                depth = top_depth
+            else:
+                depth = top_depth + os.path.relpath(directory, top).count(os.sep) + 1
+            try:
+                wd = self._inotify.add_watch(directory, _watch_mask)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    log.error("Unable to watch {dir}, raise fs.inotify.max_user_watches".format(
+                        dir=sanitize_object(directory)))
+                else:
+                    log.warning("Unable to watch {dir}: {err}".format(
+                        dir=sanitize_object(directory), err=e.strerror))
+                continue
+            self._directories[wd] = (directory, depth, descend)
+            self._watches[directory] = wd
+            for entry in files:
+                yield entry.path
+
+    def _unwatch_tree(self, top):
+        prefix = os.path.join(top, '')
+        for directory in [directory for directory in self._watches
+                          if directory == top or directory.startswith(prefix)]:
+            wd = self._watches.pop(directory)
+            self._directories.pop(wd, None)
+            self._inotify.rm_watch(wd)
+
+    def __iter__(self):
+        return self.events()
+
+    def events(self):
+        while True:
+            for wd, mask, cookie, name in self._inotify.read():
+                if mask & IN_Q_OVERFLOW:
+                    log.warning("Watch events were lost, searching again")
+                    yield OVERFLOW, None
+                    continue
+                if mask & IN_IGNORED:
+                    directory, depth, descend = self._directories.pop(wd, (None, None, None))
+                    if directory is not None and self._watches.get(directory) == wd:
+                        self._watches.pop(directory)
+                    continue
+                if wd not in self._directories:
+                    continue
+                directory, depth, descend = self._directories[wd]
+                if mask & IN_DELETE_SELF:
+                    continue
+                path = os.path.join(directory, name)
+
+                if mask & IN_ISDIR:
+                    if mask & (IN_MOVED_FROM | IN_DELETE):
+                        self._unwatch_tree(path)
+                        yield DELETED_TREE, path
+                    elif mask & (IN_MOVED_TO | IN_CREATE):
+                        if self.max_depth is not None and depth >= self.max_depth:
+                            continue
+                        if descend is not None and not descend(path):
+                            continue
+                        for file_path in self._watch_tree(path, depth + 1, descend):
+                            yield CREATED, file_path
+                elif mask & (IN_MOVED_FROM | IN_DELETE):
+                    yield DELETED, path
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    yield CREATED, path
+                elif mask & IN_CREATE:
+                    # A new file is grouped once it has been written and closed,
+                    # unless it is a hard link to an existing file which is never written
+                    try:
+                        if os.lstat(path).st_nlink > 1:
+                            yield CREATED, path
+                    except OSError:
+                        pass
+
+    def close(self):
+        self._inotify.close()
+
+
+if __name__ == '__main__':
+    pass